@@ -0,0 +1,397 @@
+import re
+import sqlite3
+import time
+from datetime import datetime
+
+from sqlalchemy import delete
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import workload
+from config import CAPTURE_QUERIES_PATH
+from database import get_sqlite_engine, sqlite_write_lock, _register_functions
+from models_sqlite import BaseSQLite, IndexAdvice
+from queries import STATEMENTS, FIRST_KEY, LAST_KEY
+
+# Index advice from the statements actually run against the SQLite DB (see
+# workload.py). Each statement is planned with EXPLAIN QUERY PLAN in an empty
+# in-memory copy of the schema that carries the target's sqlite_stat1, so
+# hypothetical indexes can be created and planned against without touching
+# the target. A plan costs the rows of every table it scans in full while
+# filtering, joining or grouping on it, plus,
+# for each temp B-tree (a sort for GROUP BY/ORDER BY/DISTINCT), the rows of
+# the largest table in the statement, times the number of runs. The planner
+# only switches to a plan it estimates cheaper, so a new index is credited
+# with the cost it takes off the statements whose plans it improves and never
+# charged for the others. Indexes are added greedily while one lowers the
+# cost; indexes another index already starts with are removed when no plan
+# gets costlier without them.
+MAX_ADDITIONS = 5
+# Smallest cost reduction (rows) worth another index to maintain.
+MIN_GAIN = 1000
+MAX_COLUMNS = 3
+# Sampled rows per column for the width of a proposed index entry.
+WIDTH_SAMPLE = 10000
+# B-tree pages filled by random inserts end up about this full.
+PAGE_FILL = 0.75
+
+_NOT_ALIASES = "JOIN|LEFT|INNER|OUTER|CROSS|ON|WHERE|GROUP|ORDER|LIMIT|USING|UNION|HAVING"
+_TABLE_REF = re.compile(rf'\b(?:FROM|JOIN)\s+"?(\w+)"?(?:\s+(?:AS\s+)?(?!(?:{_NOT_ALIASES})\b)"?(\w+)"?)?', re.I)
+_COLUMN_REF = re.compile(r'"?(\w+)"?\."?(\w+)"?')
+_CLAUSE = re.compile(r"\b(FROM|WHERE|GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT)\b", re.I)
+_CLAUSE_KIND = {"FROM": "filter", "WHERE": "filter", "GROUP BY": "group", "ORDER BY": "order"}
+
+
+class Statement:
+    def __init__(self, sql: str, params, count: int, label: str):
+        self.sql = sql
+        self.params = params
+        self.count = count
+        self.label = label
+        self.aliases: dict[str, str] = {}
+        self.refs: dict[str, dict[str, list[str]]] = {}
+        self.cost = 0.0
+        self.issues: list[str] = []
+
+
+class WhatIf:
+    # Empty in-memory copy of the target schema with its statistics.
+    def __init__(self, conn):
+        self.db = sqlite3.connect(":memory:")
+        _register_functions(self.db)
+        for (sql,) in conn.exec_driver_sql(
+                "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                "ORDER BY type = 'index'"):
+            self.db.execute(sql)
+        self.db.execute("ANALYZE")
+        self.db.execute("DELETE FROM sqlite_stat1")
+        self.db.executemany("INSERT INTO sqlite_stat1 VALUES (?, ?, ?)",
+                            [tuple(r) for r in conn.exec_driver_sql("SELECT tbl, idx, stat FROM sqlite_stat1")])
+        self.db.execute("ANALYZE sqlite_schema")
+
+    def plan(self, statement: Statement) -> list[str]:
+        return [r[3] for r in self.db.execute(f"EXPLAIN QUERY PLAN {statement.sql}", statement.params)]
+
+    def create(self, name: str, table: str, columns: tuple, stat: str | None) -> None:
+        self.db.execute(f'CREATE INDEX "{name}" ON "{table}" ({_column_list(columns)})')
+        if stat is not None:
+            self.db.execute("INSERT INTO sqlite_stat1 VALUES (?, ?, ?)", (table, name, stat))
+        self.db.execute("ANALYZE sqlite_schema")
+
+    def drop(self, name: str) -> tuple:
+        # Returns what create() needs to put the index back.
+        table = self.db.execute("SELECT tbl_name FROM sqlite_master WHERE name = ?", (name,)).fetchone()[0]
+        columns = tuple(r[2] for r in self.db.execute(f'PRAGMA index_info("{name}")'))
+        stat = self.db.execute("SELECT stat FROM sqlite_stat1 WHERE idx = ?", (name,)).fetchone()
+        self.db.execute(f'DROP INDEX "{name}"')
+        self.db.execute("DELETE FROM sqlite_stat1 WHERE idx = ?", (name,))
+        self.db.execute("ANALYZE sqlite_schema")
+        return name, table, columns, stat[0] if stat else None
+
+
+def _column_list(columns) -> str:
+    return ", ".join(f'"{c}"' for c in columns)
+
+
+def _index_name(table: str, columns: tuple) -> str:
+    return f"ix_{table}_{'_'.join(columns)}"
+
+
+def _default_workload() -> list[dict]:
+    # The queries.py statements, over all dates, when nothing was captured.
+    params = {"start_key": FIRST_KEY, "end_key": LAST_KEY, "limit": 10}
+    statements = []
+    for name, stmt in STATEMENTS.items():
+        compiled = stmt.compile(dialect=sqlite.dialect())
+        values = compiled.construct_params(params)
+        statements.append({"sql": compiled.string, "count": 1, "name": name,
+                           "params": [values[k] for k in compiled.positiontup]})
+    return statements
+
+
+def _schema(conn) -> tuple[dict, dict]:
+    # table -> (rows, columns); index name -> (table, columns, unique, created by CREATE INDEX)
+    stats = {}
+    for tbl, idx, stat in conn.exec_driver_sql("SELECT tbl, idx, stat FROM sqlite_stat1"):
+        stats[tbl] = max(stats.get(tbl, 0), int(stat.split()[0]))
+    tables, indexes = {}, {}
+    for table in BaseSQLite.metadata.tables:
+        columns = [r[1] for r in conn.exec_driver_sql(f'PRAGMA table_info("{table}")')]
+        if not columns:
+            continue
+        tables[table] = (stats.get(table, 0), columns)
+        for _, name, unique, origin, _ in conn.exec_driver_sql(f'PRAGMA index_list("{table}")'):
+            cols = tuple(r[2] for r in conn.exec_driver_sql(f'PRAGMA index_info("{name}")'))
+            indexes[name] = (table, cols, bool(unique), origin == "c")
+    return tables, indexes
+
+
+def _analyze(statement: Statement, tables: dict) -> None:
+    for table, alias in _TABLE_REF.findall(statement.sql):
+        if table in tables:
+            if alias:
+                statement.aliases[alias] = table
+            statement.aliases.setdefault(table, table)
+    parts = _CLAUSE.split(statement.sql)
+    for keyword, body in zip(parts[1::2], parts[2::2]):
+        kind = _CLAUSE_KIND.get(" ".join(keyword.upper().split()))
+        if kind is None:
+            continue
+        for alias, column in _COLUMN_REF.findall(body):
+            table = statement.aliases.get(alias)
+            if table and column in tables[table][1]:
+                seen = statement.refs.setdefault(table, {}).setdefault(kind, [])
+                if column not in seen:
+                    seen.append(column)
+
+
+def _cost(statement: Statement, plan: list[str], tables: dict) -> tuple[float, list[str]]:
+    largest = max((tables[t][0] for t in statement.aliases.values()), default=0)
+    cost, issues = 0.0, []
+    for detail in plan:
+        scan = re.match(r"SCAN (\w+)", detail)
+        # Scans of tables the statement neither filters, joins nor sorts on
+        # read every row by design.
+        if scan and statement.aliases.get(scan.group(1)) in statement.refs:
+            cost += max(tables[statement.aliases[scan.group(1)]][0], 1)
+            issues.append(detail)
+        elif detail.startswith("USE TEMP B-TREE"):
+            cost += max(largest, 1)
+            issues.append(detail)
+    return cost * statement.count, issues
+
+
+def _candidates(statement: Statement) -> set[tuple[str, tuple]]:
+    candidates = set()
+    for table, refs in statement.refs.items():
+        filters, group, order = refs.get("filter", []), refs.get("group", []), refs.get("order", [])
+        for column in filters:
+            candidates.add((table, (column,)))
+            if group:
+                candidates.add((table, tuple(dict.fromkeys((column, *group)))[:MAX_COLUMNS]))
+        for columns in (group, order):
+            if columns:
+                candidates.add((table, tuple(columns[:MAX_COLUMNS])))
+    return candidates
+
+
+class Sizer:
+    # Index sizes on the target: measured with dbstat where SQLite has it,
+    # otherwise estimated from rows times the sampled width of an entry.
+    def __init__(self, conn, tables: dict):
+        self.conn = conn
+        self.tables = tables
+        self._distinct: dict[tuple, int] = {}
+
+    def measured(self, name: str) -> int | None:
+        try:
+            return self.conn.exec_driver_sql("SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (name,)).scalar()
+        except OperationalError:
+            # SQLite built without SQLITE_ENABLE_DBSTAT_VTAB
+            return None
+
+    def estimate(self, table: str, columns: tuple) -> int:
+        width = 0.0
+        for column in columns:
+            width += 1 + (self.conn.exec_driver_sql(
+                f'SELECT AVG(CASE typeof(c) WHEN \'integer\' THEN (CASE WHEN abs(c) < 128 THEN 1 '
+                f'WHEN abs(c) < 32768 THEN 2 WHEN abs(c) < 8388608 THEN 3 WHEN abs(c) < 2147483648 THEN 4 '
+                f'ELSE 8 END) WHEN \'real\' THEN 8 WHEN \'null\' THEN 0 ELSE length(CAST(c AS BLOB)) END) '
+                f'FROM (SELECT "{column}" AS c FROM "{table}" LIMIT {WIDTH_SAMPLE})').scalar() or 0)
+        # + rowid, record header and cell pointer
+        return int(self.tables[table][0] * (width + 8) / PAGE_FILL)
+
+    def stat(self, table: str, columns: tuple) -> str:
+        # sqlite_stat1 line for a hypothetical index: rows, then rows per
+        # distinct value of each leading column prefix.
+        rows = max(self.tables[table][0], 1)
+        stat = [str(rows)]
+        for i in range(1, len(columns) + 1):
+            prefix = (table, columns[:i])
+            if prefix not in self._distinct:
+                self._distinct[prefix] = self.conn.exec_driver_sql(
+                    f'SELECT COUNT(*) FROM (SELECT DISTINCT {_column_list(columns[:i])} FROM "{table}")').scalar()
+            stat.append(str(max(1, -(-rows // max(self._distinct[prefix], 1)))))
+        return " ".join(stat)
+
+
+def _size(size: int) -> str:
+    if size < 1024 * 1024:
+        return f"{size / 1024:.0f} KB"
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+def advise(workload_path: str | None = None, apply: bool = False) -> tuple[list, list]:
+    # Prints the plan issues of the workload and the proposed index changes;
+    # with apply, makes them and records them in index_advice so later loads
+    # keep them. Returns (additions, removals) as (name, table, columns).
+    started = time.perf_counter()
+    workload_path = workload_path or CAPTURE_QUERIES_PATH
+    captured = workload.load(workload_path) if workload_path else []
+    source = workload_path if captured else "queries.py (nothing captured)"
+    entries = captured or _default_workload()
+
+    engine = get_sqlite_engine()
+    with workload.paused(), engine.connect() as conn:
+        if not conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").first():
+            # The planner, here and on the target, needs table statistics.
+            with sqlite_write_lock:
+                conn.exec_driver_sql("ANALYZE")
+                conn.commit()
+            print("Ran ANALYZE on the target (no sqlite_stat1 yet)")
+        tables, indexes = _schema(conn)
+        whatif = WhatIf(conn)
+        sizer = Sizer(conn, tables)
+
+        statements, skipped = [], 0
+        for entry in entries:
+            label = entry.get("name") or " ".join(entry["sql"].split())[:70]
+            statement = Statement(entry["sql"], entry["params"], entry["count"], label)
+            _analyze(statement, tables)
+            if not statement.aliases:
+                continue
+            try:
+                statement.cost, statement.issues = _cost(statement, whatif.plan(statement), tables)
+            except sqlite3.Error:
+                skipped += 1
+                continue
+            statements.append(statement)
+
+        runs = sum(s.count for s in statements)
+        print(f"Workload: {len(statements)} statements ({runs} runs) from {source}"
+              + (f", {skipped} could not be planned" if skipped else ""))
+        for statement in sorted(statements, key=lambda s: -s.cost):
+            if statement.issues:
+                print(f"  {statement.count}x {statement.label}")
+                for issue in statement.issues:
+                    print(f"      {issue}")
+
+        def replan(subset) -> dict:
+            return {id(s): _cost(s, whatif.plan(s), tables) for s in subset}
+
+        # Greedy additions
+        additions = []
+        current = {name: (t, cols) for name, (t, cols, _, _) in indexes.items()}
+        for _ in range(MAX_ADDITIONS):
+            best = None
+            tried = set()
+            for statement in statements:
+                if not statement.issues:
+                    continue
+                for table, columns in _candidates(statement):
+                    if (table, columns) in tried or any(
+                            t == table and cols[:len(columns)] == columns for t, cols in current.values()):
+                        continue
+                    tried.add((table, columns))
+                    affected = [s for s in statements if table in s.aliases.values()]
+                    name = _index_name(table, columns)
+                    whatif.create(name, table, columns, sizer.stat(table, columns))
+                    costs = replan(affected)
+                    whatif.drop(name)
+                    gain = sum(max(0.0, s.cost - costs[id(s)][0]) for s in affected)
+                    if gain >= MIN_GAIN and (best is None or gain > best[0]):
+                        best = (gain, name, table, columns, affected, costs)
+            if best is None:
+                break
+            gain, name, table, columns, affected, costs = best
+            whatif.create(name, table, columns, sizer.stat(table, columns))
+            fixed = 0
+            for s in affected:
+                cost, issues = costs[id(s)]
+                fixed += max(0, len(s.issues) - len(issues))
+                s.cost, s.issues = cost, issues
+            current[name] = (table, columns)
+            additions.append((name, table, columns, gain, fixed))
+
+        # Removals: non-unique indexes that another index starts with, widest
+        # first so that chains end at the index that is kept.
+        removals = []
+        for name, (table, columns, unique, created) in sorted(indexes.items(), key=lambda i: (-len(i[1][1]), i[0])):
+            if unique or not created:
+                continue
+            covering = next(((other, cols) for other, (t, cols) in sorted(current.items())
+                             if other != name and t == table and cols[:len(columns)] == columns
+                             and (len(cols) > len(columns) or other not in indexes or indexes[other][2]
+                                  or other < name)),
+                            None)
+            if covering is None:
+                continue
+            affected = [s for s in statements if table in s.aliases.values()]
+            restore = whatif.drop(name)
+            costs = replan(affected)
+            if any(costs[id(s)][0] > s.cost for s in affected):
+                whatif.create(*restore)
+                continue
+            for s in affected:
+                s.cost, s.issues = costs[id(s)]
+            del current[name]
+            removals.append((name, table, columns, covering))
+
+        if not additions and not removals:
+            print("No index changes to propose")
+        else:
+            print("Proposed:")
+        trees = {t: 1 + sum(1 for _, (it, _, _, _) in indexes.items() if it == t) for t in tables}
+        for name, table, columns, gain, fixed in additions:
+            print(f"  + CREATE INDEX {name} ON {table} ({', '.join(columns)})")
+            print(f"      removes {fixed} plan issues (cost {gain:,.0f} rows lower); "
+                  f"~{_size(sizer.estimate(table, columns))}; "
+                  f"writes to {table}: {trees[table]} -> {trees[table] + 1} b-trees per row")
+            trees[table] += 1
+        for name, table, columns, covering in removals:
+            size = sizer.measured(name)
+            size = size if size is not None else sizer.estimate(table, columns)
+            print(f"  - DROP INDEX {name}")
+            print(f"      {covering[0]} ({', '.join(covering[1])}) starts with the same columns; frees ~{_size(size)}; "
+                  f"writes to {table}: {trees[table]} -> {trees[table] - 1} b-trees per row")
+            trees[table] -= 1
+
+        used = {m.group(1) for s in statements for d in whatif.plan(s)
+                for m in [re.search(r"USING (?:COVERING )?INDEX (\w+)", d)] if m}
+        unused = sorted(n for n, (t, _, unique, created) in indexes.items()
+                        if created and n not in used and n not in {r[0] for r in removals}
+                        and any(t in s.aliases.values() for s in statements))
+        if unused:
+            print(f"Not used by this workload (kept): {', '.join(unused)}")
+
+    additions = [(name, table, columns) for name, table, columns, *_ in additions]
+    removals = [(name, table, columns) for name, table, columns, _ in removals]
+    if apply and (additions or removals):
+        _apply(engine, additions, removals)
+    print(f"Index advice done in {time.perf_counter() - started:.2f}s: {len(additions)} additions, "
+          f"{len(removals)} removals" + ("" if apply or not (additions or removals) else " (--apply to make them)"))
+    return additions, removals
+
+
+def _apply(engine, additions: list, removals: list) -> None:
+    declared = {ix.name for table in BaseSQLite.metadata.tables.values() for ix in table.indexes}
+    now = datetime.utcnow()
+    with sqlite_write_lock, engine.begin() as conn:
+        IndexAdvice.__table__.create(conn, checkfirst=True)
+        for name, table, columns in additions:
+            conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({_column_list(columns)})')
+            conn.exec_driver_sql(f'ANALYZE "{name}"')
+            if name in declared:
+                # A declared index that was missing; nothing to remember.
+                conn.execute(delete(IndexAdvice).where(IndexAdvice.name == name))
+            else:
+                _record(conn, name, table, columns, "add", now)
+            print(f"Created {name}")
+        for name, table, columns in removals:
+            conn.exec_driver_sql(f'DROP INDEX IF EXISTS "{name}"')
+            if name in declared:
+                _record(conn, name, table, columns, "drop", now)
+            else:
+                conn.execute(delete(IndexAdvice).where(IndexAdvice.name == name))
+            print(f"Dropped {name}")
+
+
+def _record(conn, name: str, table: str, columns: tuple, action: str, now: datetime) -> None:
+    stmt = sqlite_insert(IndexAdvice.__table__).values(
+        name=name, table_name=table, columns=",".join(columns), action=action, applied_at=now)
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=[IndexAdvice.name],
+        set_={c: stmt.excluded[c] for c in ("table_name", "columns", "action", "applied_at")},
+    ))
@@ -0,0 +1,319 @@
+import time
+
+from sqlalchemy import select, func, delete, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import partitions
+from database import get_sqlite_session, sqlite_write_lock
+from querycache import mark_repaired
+from models_sqlite import (
+    FactRental, FactPayment, BridgeFilmCategory, DimStore, DimCategory,
+    AggStoreDayRevenue, AggStoreDayRentals, AggCategoryDayRentals, AggOpenRentals,
+)
+from sqlexpr import cents
+
+# Summary tables maintained from the rows the fact loaders write. Every batch
+# a BatchWriter flushes into a fact table first passes through tracker():
+# the aggregate rows it touches are adjusted by the difference between the
+# fact rows being replaced and their new values, in the same transaction.
+# check() recomputes each aggregate from the facts and can rebuild it.
+IN_BATCH = 500
+
+
+def _revenue():
+    return (
+        select(FactPayment.date_key_paid, FactPayment.store_key, func.count(),
+               func.sum(cents(FactPayment.amount)))
+        .group_by(FactPayment.date_key_paid, FactPayment.store_key)
+    )
+
+
+def _store_rentals():
+    return (
+        select(FactRental.date_key_rented, FactRental.store_key, func.count())
+        .group_by(FactRental.date_key_rented, FactRental.store_key)
+    )
+
+
+def _category_rentals():
+    return (
+        select(FactRental.date_key_rented, BridgeFilmCategory.category_key, func.count())
+        .join_from(FactRental, BridgeFilmCategory, FactRental.film_key == BridgeFilmCategory.film_key)
+        .group_by(FactRental.date_key_rented, BridgeFilmCategory.category_key)
+    )
+
+
+def _open_rentals():
+    return (
+        select(FactRental.store_key, func.count())
+        .where(FactRental.date_key_returned.is_(None))
+        .group_by(FactRental.store_key)
+    )
+
+
+# name -> (model, fact model it summarizes, query computing it from scratch
+# with the table's columns in order)
+AGGREGATES = {
+    "agg_store_day_revenue": (AggStoreDayRevenue, FactPayment, _revenue),
+    "agg_store_day_rentals": (AggStoreDayRentals, FactRental, _store_rentals),
+    "agg_category_day_rentals": (AggCategoryDayRentals, FactRental, _category_rentals),
+    "agg_open_rentals": (AggOpenRentals, FactRental, _open_rentals),
+}
+
+# fact model -> natural key column
+FACT_KEYS = {FactRental: FactRental.rental_id, FactPayment: FactPayment.payment_id}
+
+
+def _cents(amount: float) -> int:
+    # Rounds half away from zero, like SQLite's round() in sqlexpr.cents().
+    return int(amount * 100 + (0.5 if amount >= 0 else -0.5))
+
+
+def _chunks(values, size: int = IN_BATCH):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def film_categories(sqlite_session) -> dict[int, list[int]]:
+    categories: dict[int, list[int]] = {}
+    for film_key, category_key in sqlite_session.execute(
+            select(BridgeFilmCategory.film_key, BridgeFilmCategory.category_key)):
+        categories.setdefault(film_key, []).append(category_key)
+    return categories
+
+
+class Delta:
+    # Measure increments per aggregate row, written with one upsert per table.
+    def __init__(self, categories: dict[int, list[int]] | None = None):
+        self.categories = categories or {}
+        self.rows: dict = {}
+        self.shrinks = False
+
+    def add(self, model, key: tuple, *measures: int) -> None:
+        current = self.rows.setdefault(model, {}).get(key)
+        if current is None:
+            self.rows[model][key] = list(measures)
+        else:
+            for i, m in enumerate(measures):
+                current[i] += m
+        self.shrinks = self.shrinks or measures[0] < 0
+
+    def rental(self, row, sign: int) -> None:
+        self.add(AggStoreDayRentals, (row["date_key_rented"], row["store_key"]), sign)
+        for category_key in self.categories.get(row["film_key"], ()):
+            self.add(AggCategoryDayRentals, (row["date_key_rented"], category_key), sign)
+        if row["date_key_returned"] is None:
+            self.add(AggOpenRentals, (row["store_key"],), sign)
+
+    def payment(self, row, sign: int) -> None:
+        self.add(AggStoreDayRevenue, (row["date_key_paid"], row["store_key"]), sign,
+                 sign * _cents(row["amount"]))
+
+    def fact(self, model, row, sign: int) -> None:
+        if model is FactRental:
+            self.rental(row, sign)
+        else:
+            self.payment(row, sign)
+
+    def apply(self, sqlite_session) -> None:
+        for model, rows in self.rows.items():
+            table = model.__table__
+            keys = [c.name for c in table.primary_key.columns]
+            measures = [c.name for c in table.columns if not c.primary_key]
+            values = [dict(zip(keys, k), **dict(zip(measures, v))) for k, v in rows.items() if any(v)]
+            if not values:
+                continue
+            stmt = sqlite_insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=keys,
+                set_={m: table.c[m] + stmt.excluded[m] for m in measures},
+            )
+            sqlite_session.execute(stmt, values)
+            if self.shrinks:
+                # The first measure is the row count; rows counting nothing go.
+                sqlite_session.execute(delete(table).where(table.c[measures[0]] == 0))
+        self.rows = {}
+        self.shrinks = False
+
+
+def _current_rows(sqlite_session, model, ids):
+    if partitions.enabled(model):
+        yield from partitions.current_rows(sqlite_session, model, ids)
+        return
+    table = model.__table__
+    key = table.c[FACT_KEYS[model].key]
+    for batch in _chunks(ids):
+        yield from sqlite_session.execute(select(table).where(key.in_(batch))).mappings()
+
+
+def tracker(sqlite_session, model, replaces: bool = True):
+    # BatchWriter on_flush callback keeping the aggregates of a fact table
+    # current, or None for tables without aggregates. replaces=False skips
+    # the lookup of existing rows when every row written is new.
+    if model not in FACT_KEYS:
+        return None
+    key = FACT_KEYS[model].key
+    delta = Delta(film_categories(sqlite_session) if model is FactRental else None)
+
+    def track(rows: list[dict]) -> None:
+        if replaces:
+            for old in _current_rows(sqlite_session, model, [r[key] for r in rows]):
+                delta.fact(model, old, -1)
+        for row in rows:
+            delta.fact(model, row, 1)
+        delta.apply(sqlite_session)
+    return track
+
+
+def forget(sqlite_session, model, ids) -> None:
+    # Takes fact rows that are about to be deleted out of the aggregates.
+    if model not in FACT_KEYS:
+        return
+    delta = Delta(film_categories(sqlite_session) if model is FactRental else None)
+    for old in _current_rows(sqlite_session, model, ids):
+        delta.fact(model, old, -1)
+    delta.apply(sqlite_session)
+
+
+def reset(sqlite_session, model, shard=None) -> None:
+    # The fact table was emptied, or with shard only that shard's rows of it;
+    # so are its aggregates, whose stores and categories are per shard too.
+    for agg, fact, _ in AGGREGATES.values():
+        if fact is not model:
+            continue
+        stmt = delete(agg)
+        kept = partitions.frozen_periods(sqlite_session, model) if partitions.enabled(model) else []
+        if kept and "date_key" in agg.__table__.c:
+            # Frozen partitions are not reloaded; their days stay counted.
+            stmt = stmt.where(~partitions.in_periods(agg.date_key, kept))
+        if shard is not None:
+            if "category_key" in agg.__table__.c:
+                others = shard.others(DimCategory.category_key, DimCategory.category_id)
+                stmt = stmt.where(agg.category_key.not_in(others))
+            else:
+                stmt = stmt.where(agg.store_key.not_in(shard.others(DimStore.store_key, DimStore.store_id)))
+        sqlite_session.execute(stmt)
+        if kept and agg is AggOpenRentals:
+            _count_frozen_open(sqlite_session, shard)
+
+
+def _count_frozen_open(sqlite_session, shard=None) -> None:
+    # Open rentals have no day to keep apart, so those of frozen partitions
+    # are counted again (with shard, only at the shard's stores).
+    others = set(sqlite_session.execute(shard.others(DimStore.store_key, DimStore.store_id)).scalars()) \
+        if shard is not None else set()
+    delta = Delta()
+    for conn in partitions.connections(sqlite_session, FactRental, frozen=True):
+        for store_key, n in conn.execute(_open_rentals()):
+            if store_key not in others:
+                delta.add(AggOpenRentals, (store_key,), n)
+    delta.apply(sqlite_session)
+
+
+def relink_categories(sqlite_session, inserted, deleted) -> None:
+    # bridge_film_category pairs (film_key, category_key) were added or
+    # removed: move each film's rentals per day into or out of the category.
+    pairs = [(f, c, 1) for f, c in inserted] + [(f, c, -1) for f, c in deleted]
+    if not pairs:
+        return
+    per_day: dict[int, list[tuple[int, int]]] = {}
+    for batch in _chunks({f for f, _, _ in pairs}):
+        stmt = (select(FactRental.film_key, FactRental.date_key_rented, func.count())
+                .where(FactRental.film_key.in_(batch))
+                .group_by(FactRental.film_key, FactRental.date_key_rented))
+        # Partitions hold distinct days, so their groups do not overlap.
+        for film_key, date_key, n in _fact_rows(sqlite_session, FactRental, stmt):
+            per_day.setdefault(film_key, []).append((date_key, n))
+
+    delta = Delta()
+    for film_key, category_key, sign in pairs:
+        for date_key, n in per_day.get(film_key, ()):
+            delta.add(AggCategoryDayRentals, (date_key, category_key), sign * n)
+    delta.apply(sqlite_session)
+
+
+def _fact_rows(sqlite_session, fact, stmt):
+    # stmt (reading fact alone) run on the main database or on every partition.
+    if not partitions.enabled(fact):
+        yield from sqlite_session.execute(stmt)
+        return
+    for conn in partitions.connections(sqlite_session, fact):
+        yield from conn.execute(stmt)
+
+
+def computed(sqlite_session, name: str) -> dict[tuple, tuple]:
+    # The aggregate computed from the facts, as key columns -> measures.
+    model, fact, query = AGGREGATES[name]
+    width = len(model.__table__.primary_key.columns)
+    if not partitions.enabled(fact):
+        return {tuple(r[:width]): tuple(r[width:]) for r in sqlite_session.execute(query())}
+    # Summed over the partitions; they hold no bridge, so categories are
+    # looked up here.
+    totals = {}
+    if model is AggCategoryDayRentals:
+        categories = film_categories(sqlite_session)
+        stmt = (select(FactRental.date_key_rented, FactRental.film_key, func.count())
+                .group_by(FactRental.date_key_rented, FactRental.film_key))
+        rows = ((date_key, category_key, n) for date_key, film_key, n in _fact_rows(sqlite_session, fact, stmt)
+                for category_key in categories.get(film_key, ()))
+    else:
+        rows = _fact_rows(sqlite_session, fact, query())
+    for r in rows:
+        key, measures = tuple(r[:width]), tuple(r[width:])
+        current = totals.get(key)
+        totals[key] = measures if current is None else tuple(a + b for a, b in zip(current, measures))
+    return totals
+
+
+def rebuild(sqlite_session, name: str) -> int:
+    model, fact, query = AGGREGATES[name]
+    table = model.__table__
+    sqlite_session.execute(delete(table))
+    if partitions.enabled(fact):
+        columns = [c.name for c in table.columns]
+        values = [dict(zip(columns, key + measures)) for key, measures in computed(sqlite_session, name).items()]
+        if values:
+            sqlite_session.execute(insert(table), values)
+    else:
+        sqlite_session.execute(insert(table).from_select([c.name for c in table.columns], query()))
+    return sqlite_session.query(func.count()).select_from(table).scalar()
+
+
+def check(tables: list[str] | None = None, rebuild_all: bool = False) -> list[str]:
+    # Compares each aggregate with the same summary computed from the fact
+    # tables. Returns the names that differed; with rebuild_all every checked
+    # aggregate is recomputed from scratch afterwards.
+    unknown = set(tables or ()) - set(AGGREGATES)
+    if unknown:
+        raise ValueError(f"Unknown aggregate(s): {', '.join(sorted(unknown))}")
+
+    started = time.perf_counter()
+    session = get_sqlite_session()
+    differing = []
+    try:
+        for name, (model, _, _) in AGGREGATES.items():
+            if tables and name not in tables:
+                continue
+            width = len(model.__table__.primary_key.columns)
+            expected = computed(session, name)
+            stored = {tuple(r[:width]): tuple(r[width:]) for r in session.execute(select(model.__table__))}
+            wrong = sum(1 for k in expected.keys() | stored.keys() if expected.get(k) != stored.get(k))
+            if wrong:
+                differing.append(name)
+                print(f"{name}: {wrong} of {len(expected)} rows differ from the facts")
+            else:
+                print(f"{name}: consistent ({len(stored)} rows)")
+
+            if rebuild_all:
+                with sqlite_write_lock:
+                    rows = rebuild(session, name)
+                    mark_repaired(session)
+                    session.commit()
+                print(f"  rebuilt: {rows} rows")
+    finally:
+        session.close()
+
+    print(f"Aggregate check done in {time.perf_counter() - started:.2f}s: "
+          f"{len(differing)} inconsistent")
+    return differing
@@ -1,24 +1,139 @@
 import argparse
+from datetime import date
 from sync import init_db, full_load, incremental, validate
+from metrics import stats
+from reconcile import reconcile, SPECS
+from watch import watch
+from aggregates import check, AGGREGATES
+from queries import run_query, QUERIES
+from columnar import export_columnar, EXPORTS
+from advisor import advise
+from fleet import fleet
+from partitions import show as show_partitions
+from config import (BATCH_SIZE, CHUNK_SIZE, SYNC_WORKERS, SQLITE_PROFILE, EXTRACT_PARALLELISM,
+                    VALIDATE_WINDOWS, WATCH_MIN_INTERVAL, WATCH_MAX_INTERVAL, FLEET_MANIFEST, FLEET_WORKERS)
+from database import dispose, SQLITE_PROFILES
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("command", choices=["init", "full-load", "incremental", "validate"])
+    parser.add_argument("command", choices=["init", "full-load", "incremental", "validate", "stats",
+                                            "reconcile", "watch", "check-aggregates", "query",
+                                            "export-columnar", "advise-indexes", "fleet", "partitions"])
+    parser.add_argument("query_name", nargs="?", choices=list(QUERIES), metavar="QUERY",
+                        help=f"query: one of {', '.join(QUERIES)}")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="rows per bulk insert/upsert batch for full-load and incremental")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="rows streamed per chunk from MySQL for full-load and incremental")
+    parser.add_argument("--workers", type=int, default=SYNC_WORKERS,
+                        help="table stages to run concurrently for full-load and incremental")
+    parser.add_argument("--sqlite-profile", choices=list(SQLITE_PROFILES), default=SQLITE_PROFILE,
+                        help="SQLite pragma profile for full-load ('bulk' is fastest)")
+    parser.add_argument("--defer-indexes", action="store_true",
+                        help="drop secondary indexes during full-load and rebuild them at the end")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted full-load from its last committed chunk")
+    parser.add_argument("--extract-parallelism", type=int, default=EXTRACT_PARALLELISM,
+                        help="concurrent primary-key ranges read per fact table during full-load")
+    parser.add_argument("--json-metrics", action="store_true",
+                        help="print per-stage metrics of full-load/incremental as JSON lines")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="recent runs per stage shown by stats")
+    parser.add_argument("--regression-threshold", type=float, default=0.2,
+                        help="throughput drop vs the median of earlier runs flagged by stats")
+    parser.add_argument("--tables",
+                        help="comma-separated target tables for reconcile "
+                             f"(default: all of {', '.join(s.name for s in SPECS)}) "
+                             "or aggregates for check-aggregates "
+                             f"(default: all of {', '.join(AGGREGATES)}) "
+                             f"or fact tables for export-columnar ({', '.join(EXPORTS)})")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="reconcile: report differences without repairing them")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="check-aggregates: recompute the checked aggregates from the fact tables")
+    parser.add_argument("--from", dest="start", type=date.fromisoformat,
+                        help="query: first day included (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="end", type=date.fromisoformat,
+                        help="query: last day included (YYYY-MM-DD)")
+    parser.add_argument("--limit", type=int, default=10, help="query: rows returned by ranked queries")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="query: run it this many times and report warm timing too")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="query: bypass the result cache")
+    parser.add_argument("--output", default="columnar",
+                        help="export-columnar: directory holding one sub-directory per table")
+    parser.add_argument("--full", action="store_true",
+                        help="export-columnar: rewrite the export instead of appending to it; "
+                             "fleet: full-load every tenant instead of incremental")
+    parser.add_argument("--workload",
+                        help="advise-indexes: captured workload file (default: SYNC_CAPTURE_QUERIES)")
+    parser.add_argument("--apply", action="store_true",
+                        help="advise-indexes: create and drop the proposed indexes")
+    parser.add_argument("--windows", default=",".join(map(str, VALIDATE_WINDOWS)),
+                        help="comma-separated day windows checked by validate")
+    parser.add_argument("--report", help="validate, fleet: write the JSON report to this file")
+    parser.add_argument("--manifest", default=FLEET_MANIFEST,
+                        help="fleet: JSON tenant manifest (default: SYNC_FLEET_MANIFEST)")
+    parser.add_argument("--tenants", type=int, default=FLEET_WORKERS,
+                        help="fleet: tenants synced concurrently")
+    parser.add_argument("--freeze-before", type=date.fromisoformat,
+                        help="partitions: make partitions that ended before this day (YYYY-MM-DD) read-only")
+    parser.add_argument("--thaw", type=int,
+                        help="partitions: make the partitions of this period (yyyy or yyyymm) writable again")
+    parser.add_argument("--min-interval", type=float, default=WATCH_MIN_INTERVAL,
+                        help="watch: seconds between polls while the source is changing")
+    parser.add_argument("--max-interval", type=float, default=WATCH_MAX_INTERVAL,
+                        help="watch: longest wait between polls while the source is idle")
     args = parser.parse_args()
 
 
-    if args.command == "init":
-        init_db()
-        print("Init completed. You can now run 'full-load' to load all data, "
-        "or 'incremental' to sync changes.")
-    elif args.command == "full-load":
-        full_load()
-    elif args.command == "incremental":
-        incremental()
-    elif args.command == "validate":
-        validate()
-    else:
-        print("Not implemented yet:", args.command)
+    try:
+        if args.command == "init":
+            init_db()
+            print("Init completed. You can now run 'full-load' to load all data, "
+            "or 'incremental' to sync changes.")
+        elif args.command == "full-load":
+            full_load(batch_size=args.batch_size, chunk_size=args.chunk_size,
+                      workers=args.workers, profile=args.sqlite_profile,
+                      defer_indexes=args.defer_indexes, resume=args.resume,
+                      extract_parallelism=args.extract_parallelism,
+                      json_metrics=args.json_metrics)
+        elif args.command == "incremental":
+            incremental(batch_size=args.batch_size, chunk_size=args.chunk_size,
+                        workers=args.workers, json_metrics=args.json_metrics)
+        elif args.command == "validate":
+            validate(windows=tuple(int(d) for d in args.windows.split(",")), report_path=args.report)
+        elif args.command == "reconcile":
+            reconcile(tables=args.tables.split(",") if args.tables else None,
+                      dry_run=args.dry_run, batch_size=args.batch_size)
+        elif args.command == "watch":
+            watch(min_interval=args.min_interval, max_interval=args.max_interval,
+                  batch_size=args.batch_size, chunk_size=args.chunk_size, workers=args.workers)
+        elif args.command == "check-aggregates":
+            check(tables=args.tables.split(",") if args.tables else None, rebuild_all=args.rebuild)
+        elif args.command == "query":
+            if args.query_name is None:
+                parser.error(f"query needs one of: {', '.join(QUERIES)}")
+            run_query(args.query_name, start=args.start, end=args.end, limit=args.limit, repeat=args.repeat,
+                      use_cache=not args.no_cache)
+        elif args.command == "export-columnar":
+            export_columnar(output=args.output, tables=args.tables.split(",") if args.tables else None,
+                            full=args.full)
+        elif args.command == "advise-indexes":
+            advise(workload_path=args.workload, apply=args.apply)
+        elif args.command == "fleet":
+            if not args.manifest:
+                parser.error("fleet needs --manifest or SYNC_FLEET_MANIFEST")
+            fleet(args.manifest, full=args.full, tenant_workers=args.tenants, batch_size=args.batch_size,
+                  chunk_size=args.chunk_size, workers=args.workers, report_path=args.report)
+        elif args.command == "partitions":
+            show_partitions(freeze_before=args.freeze_before, thaw_period=args.thaw)
+        elif args.command == "stats":
+            stats(runs=args.runs, threshold=args.regression_threshold)
+        else:
+            print("Not implemented yet:", args.command)
+    finally:
+        dispose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from synthetic import generate_source, apply_changes, source_url
+
+# Compares full-load wall time per SQLite connection profile against the
+# MySQL source in MYSQL_URL. Each run loads into a fresh SQLite file.
+#
+# With --scale, runs init, full-load, incremental and validate instead against
+# synthetic Sakila sources (synthetic.py) of each scale factor and appends wall
+# time, rows/s and peak RSS per stage to a JSON results file.
+
+TARGET_TABLES = ("dim_film", "dim_actor", "dim_category", "dim_store", "dim_customer",
+                 "bridge_film_actor", "bridge_film_category", "fact_rental", "fact_payment")
+
+
+def run_app(args: list[str], env: dict) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "app.py", *args], env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def run_measured(args: list[str], env: dict) -> tuple[float, float | None]:
+    # Wall time and peak RSS (MB) of one app.py run. Peak RSS needs os.wait4,
+    # which is not available on Windows.
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "app.py", *args], env=env, stdout=subprocess.DEVNULL)
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        peak_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    else:
+        proc.wait()
+        peak_mb = None
+    elapsed = time.perf_counter() - started
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, ["app.py", *args])
+    return elapsed, peak_mb
+
+
+def target_rows(db_path: Path) -> int:
+    with sqlite3.connect(db_path) as con:
+        return sum(con.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in TARGET_TABLES)
+
+
+def stage_result(name: str, elapsed: float, rows: int, peak_mb: float | None) -> dict:
+    return {
+        "stage": name,
+        "seconds": round(elapsed, 3),
+        "rows": rows,
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed > 0 else None,
+        "peak_rss_mb": round(peak_mb, 1) if peak_mb is not None else None,
+    }
+
+
+def bench_scale(scale: float, change_ratio: float, tmp: Path, extra: list[str]) -> dict:
+    source = tmp / f"source_{scale:g}x.db"
+    target = tmp / f"target_{scale:g}x.db"
+    started = time.perf_counter()
+    counts = generate_source(source, scale)
+    print(f"Generated {scale:g}x source: {counts['rental']} rentals "
+          f"in {time.perf_counter() - started:.2f}s")
+
+    env = os.environ.copy()
+    env["MYSQL_URL"] = source_url(source)
+    env["SQLITE_URL"] = f"sqlite:///{target}"
+
+    stages = []
+    elapsed, peak = run_measured(["init"], env)
+    stages.append(stage_result("init", elapsed, 0, peak))
+    elapsed, peak = run_measured(["full-load", *extra], env)
+    stages.append(stage_result("full_load", elapsed, target_rows(target), peak))
+
+    changes = apply_changes(source, change_ratio)
+    elapsed, peak = run_measured(["incremental"], env)
+    stages.append(stage_result("incremental", elapsed, sum(changes.values()), peak))
+
+    elapsed, peak = run_measured(["validate"], env)
+    stages.append(stage_result("validate", elapsed, counts["rental"] + counts["payment"], peak))
+
+    for stage in stages:
+        rate = f"{stage['rows_per_sec']:>12,.0f} rows/s" if stage["rows"] else " " * 19
+        rss = f"{stage['peak_rss_mb']:8.1f} MB" if stage["peak_rss_mb"] is not None else ""
+        print(f"  {stage['stage']:<12} {stage['seconds']:8.2f}s {rate} {rss}")
+    return {"scale": scale, "source_rows": counts, "stages": stages}
+
+
+def load_results(path: Path) -> list:
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_comparison(previous: list, run: dict) -> None:
+    # Wall time change per stage against the last recorded run of each scale.
+    for result in run["results"]:
+        before = next((r for old in reversed(previous) for r in old["results"]
+                       if r["scale"] == result["scale"]), None)
+        if before is None:
+            continue
+        seconds = {s["stage"]: s["seconds"] for s in before["stages"]}
+        changes = [f"{s['stage']} {100 * (s['seconds'] / seconds[s['stage']] - 1):+.0f}%"
+                   for s in result["stages"] if seconds.get(s["stage"])]
+        print(f"{result['scale']:g}x vs previous run: " + ", ".join(changes))
+
+
+def bench_scales(scales: list[float], change_ratio: float, output: Path, extra: list[str]) -> dict:
+    run = {
+        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "change_ratio": change_ratio,
+        "full_load_args": extra,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in scales:
+            run["results"].append(bench_scale(scale, change_ratio, Path(tmp), extra))
+
+    previous = load_results(output)
+    print_comparison(previous, run)
+    with open(output, "w") as f:
+        json.dump(previous + [run], f, indent=2)
+    print(f"Results appended to {output}")
+    return run
+
+
+def bench_profiles(profiles: list[str], repeat: int, extra: list[str]) -> dict[str, float]:
+    best = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for profile in profiles:
+            for i in range(repeat):
+                db_path = Path(tmp) / f"bench_{profile}_{i}.db"
+                env = os.environ.copy()
+                env["SQLITE_URL"] = f"sqlite:///{db_path}"
+                run_app(["init"], env)
+                elapsed = run_app(["full-load", "--sqlite-profile", profile, *extra], env)
+                print(f"{profile:<8} run {i + 1}: {elapsed:.2f}s")
+                best[profile] = min(best.get(profile, elapsed), elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark full-load per SQLite profile")
+    parser.add_argument("--profiles", default="default,bulk")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scale", help="comma-separated scale factors to run against synthetic "
+                                        "sources, e.g. 1,10,100")
+    parser.add_argument("--change-ratio", type=float, default=0.01,
+                        help="fraction of rentals changed before the incremental run (--scale)")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"),
+                        help="JSON file --scale results are appended to")
+    args, extra = parser.parse_known_args()
+
+    if args.scale:
+        bench_scales([float(s) for s in args.scale.split(",")], args.change_ratio, args.output, extra)
+        return
+
+    if not os.getenv("MYSQL_URL"):
+        sys.exit("MYSQL_URL must point at a Sakila source to benchmark against.")
+
+    best = bench_profiles(args.profiles.split(","), args.repeat, extra)
+    baseline = best.get("default")
+    print("\nBest of", args.repeat)
+    for profile, elapsed in best.items():
+        speedup = f"  {baseline / elapsed:.2f}x vs default" if baseline else ""
+        print(f"  {profile:<8} {elapsed:.2f}s{speedup}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import time
+
+from sqlalchemy import insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import metrics
+from config import BATCH_SIZE
+
+
+class BatchWriter:
+    # Buffers plain dict rows and sends them as one executemany per batch,
+    # bypassing the ORM unit of work. With conflict_on set, each batch becomes
+    # a single INSERT ... ON CONFLICT(<natural key>) DO UPDATE, so incremental
+    # sync never has to look a row up before writing it. With returning set,
+    # the given columns of every written row are collected in self.returned.
+    # on_flush, if given, is called with each batch just before it is written
+    # (aggregates.tracker() uses it to adjust the summary tables).
+    def __init__(self, session, model, batch_size: int = BATCH_SIZE,
+                 conflict_on: str | None = None, returning: tuple = (), on_flush=None):
+        self.session = session
+        self.table = model.__table__
+        self.batch_size = max(1, batch_size)
+        self.conflict_on = conflict_on
+        self.returning = tuple(returning)
+        self.on_flush = on_flush
+        self.stmt = None
+        self.pending: list[dict] = []
+        self.returned: list[tuple] = []
+        self.written = 0
+
+    def add(self, row: dict) -> None:
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        if self.stmt is None:
+            self.stmt = self._statement(self.pending[0].keys())
+        # Counted as load time of the stage running on this thread.
+        with metrics.current().phase("load"):
+            if self.on_flush is not None:
+                self.on_flush(self.pending)
+            result = self.session.execute(self.stmt, self.pending)
+            if self.returning:
+                self.returned.extend(tuple(row) for row in result)
+        self.written += len(self.pending)
+        self.pending = []
+
+    def _statement(self, columns):
+        if self.conflict_on is None:
+            stmt = insert(self.table)
+        else:
+            stmt = sqlite_insert(self.table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[self.table.c[self.conflict_on]],
+                set_={name: stmt.excluded[name] for name in columns if name != self.conflict_on},
+            )
+        if self.returning:
+            stmt = stmt.returning(*(self.table.c[c.key] for c in self.returning))
+        return stmt
+
+
+def load_rate(rows: int, started: float) -> str:
+    elapsed = time.perf_counter() - started
+    rate = rows / elapsed if elapsed > 0 else 0.0
+    return f"in {elapsed:.2f}s ({rate:,.0f} rows/s)"
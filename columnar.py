@@ -0,0 +1,372 @@
+import json
+import math
+import mmap
+import os
+import shutil
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+
+from sqlalchemy import select, func, or_, Integer, Float
+
+import partitions
+from database import get_sqlite_session
+from models_sqlite import (
+    DimFilm, DimStore, DimCustomer, FactRental, FactPayment, LoadCheckpoint,
+)
+from shards import sync_names
+
+# Columnar snapshots of the fact tables for bulk readers. Each table is a
+# directory holding header.json and one file per column: fixed-width native
+# arrays (int64 "q", float64 "d") and, for text, int32 "i" codes into a
+# <column>.dict.json list. Nulls are INT_NULL, NaN and code -1. Files are
+# written with array.tofile() and read back through mmap + memoryview.cast(),
+# so a reader never copies or parses the data (numpy.frombuffer() accepts
+# the same views).
+#
+# Rows are ordered by the fact table's surrogate key. Appends add rows past
+# the last exported key and rewrite, in place, the rows whose last_update
+# moved past the exported watermark, or whose joined dimension rows moved
+# past the dimensions' watermark. A reload or deleted rows mean the
+# positions no longer line up, and the table is exported again in full.
+FORMAT = 1
+INT_NULL = -2 ** 63
+CHUNK = 50000
+
+
+class Export:
+    # name, fact model, its surrogate key, and the dimension attributes
+    # exported next to the fact columns as (name, column, outer join).
+    def __init__(self, name: str, model, key, dimensions):
+        self.name = name
+        self.model = model
+        self.key = key
+        self.dimensions = dimensions
+
+    def columns(self) -> list[tuple[str, object, str]]:
+        # (name, column, kind) with kind "q", "d" or "dict"
+        cols = [(c.name, c, _kind(c)) for c in self.model.__table__.columns if c.name != "last_update"]
+        cols += [(name, column, _kind(column)) for name, column, _ in self.dimensions]
+        return cols
+
+    def tables(self) -> list:
+        # The dimension tables joined, in join order.
+        return list(dict.fromkeys(column.table for _, column, _ in self.dimensions))
+
+    def query(self):
+        q = select(*(c.label(name) for name, c, _ in self.columns()), self.model.last_update)
+        q = q.select_from(self.model)
+        joined = set()
+        for _, column, onclause in self.dimensions:
+            if column.table not in joined:
+                q = q.outerjoin(column.table, onclause)
+                joined.add(column.table)
+        return q
+
+
+def _kind(column) -> str:
+    if isinstance(column.type, Integer):
+        return "q"
+    if isinstance(column.type, Float):
+        return "d"
+    return "dict"
+
+
+EXPORTS = {
+    "fact_rental": Export("fact_rental", FactRental, FactRental.fact_rental_key, [
+        ("film_title", DimFilm.title, FactRental.film_key == DimFilm.film_key),
+        ("film_rating", DimFilm.rating, FactRental.film_key == DimFilm.film_key),
+        ("store_city", DimStore.city, FactRental.store_key == DimStore.store_key),
+        ("customer_country", DimCustomer.country, FactRental.customer_key == DimCustomer.customer_key),
+    ]),
+    "fact_payment": Export("fact_payment", FactPayment, FactPayment.fact_payment_key, [
+        ("store_city", DimStore.city, FactPayment.store_key == DimStore.store_key),
+        ("customer_country", DimCustomer.country, FactPayment.customer_key == DimCustomer.customer_key),
+    ]),
+}
+
+
+class _Encoder:
+    # Buffers one column; text goes through a dictionary that only grows, so
+    # codes already on disk stay valid across appends.
+    def __init__(self, kind: str, dictionary: list | None = None):
+        self.kind = kind
+        self.dictionary = list(dictionary or [])
+        self.codes = {v: i for i, v in enumerate(self.dictionary)}
+        self.values = array("i" if kind == "dict" else kind)
+
+    def encode(self, value):
+        if self.kind == "dict":
+            if value is None:
+                return -1
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.dictionary)
+                self.dictionary.append(value)
+            return code
+        if value is None:
+            return INT_NULL if self.kind == "q" else math.nan
+        return value
+
+    def extend(self, values) -> None:
+        self.values.extend(map(self.encode, values))
+
+
+def _encode_chunk(encoders: list[_Encoder], chunk, watermark):
+    # Adds a chunk of query rows (columns in encoder order, then last_update)
+    # column by column; returns the new watermark.
+    transposed = list(zip(*chunk))
+    for encoder, values in zip(encoders, transposed):
+        encoder.extend(values)
+    stamps = [ts for ts in transposed[-1] if ts is not None]
+    if stamps and (watermark is None or max(stamps) > watermark):
+        watermark = max(stamps)
+    return watermark
+
+
+def _write_json(path: str, data) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _dimensions_watermark(session, spec: Export) -> datetime | None:
+    stamps = [session.execute(select(func.max(table.c.last_update))).scalar() for table in spec.tables()]
+    stamps = [ts for ts in stamps if ts is not None]
+    return max(stamps) if stamps else None
+
+
+def _isoformat(ts: datetime | None) -> str | None:
+    return ts.isoformat() if ts else None
+
+
+def _loaded_at(session, name: str) -> str | None:
+    # Changes whenever full-load (re)writes the table, for any shard.
+    checkpoint = session.query(func.max(LoadCheckpoint.updated_at)) \
+        .filter(LoadCheckpoint.table_name.in_(sync_names(name))).scalar()
+    return checkpoint.isoformat() if checkpoint else None
+
+
+def _column_file(column: str) -> str:
+    return f"{column}.col"
+
+
+def export_full(session, spec: Export, directory: str) -> int:
+    # Writes the table into a sibling directory and swaps it in, so open
+    # readers keep their (unlinked) files.
+    tmp = f"{directory}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    columns = spec.columns()
+    encoders = {name: _Encoder(kind) for name, _, kind in columns}
+    files = {name: open(os.path.join(tmp, _column_file(name)), "wb") for name, _, _ in columns}
+    rows = 0
+    watermark = last_key = None
+    # Taken first: dimension changes made while the table is read get rewritten by the next append.
+    dimensions_watermark = _dimensions_watermark(session, spec)
+    try:
+        for chunk in session.execute(spec.query().order_by(spec.key)).partitions(CHUNK):
+            watermark = _encode_chunk(list(encoders.values()), chunk, watermark)
+            last_key = chunk[-1]._mapping[spec.key.key]
+            for name, encoder in encoders.items():
+                encoder.values.tofile(files[name])
+                del encoder.values[:]
+            rows += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+
+    for name, encoder in encoders.items():
+        if encoder.kind == "dict":
+            _write_json(os.path.join(tmp, f"{name}.dict.json"), encoder.dictionary)
+    _write_json(os.path.join(tmp, "header.json"), {
+        "format": FORMAT, "table": spec.name, "rows": rows, "byteorder": sys.byteorder,
+        "key": spec.key.key, "last_key": last_key,
+        "watermark": _isoformat(watermark),
+        "dimensions_watermark": _isoformat(dimensions_watermark),
+        "loaded_at": _loaded_at(session, spec.name),
+        "columns": [{"name": name, "type": kind, "file": _column_file(name)} for name, _, kind in columns],
+    })
+
+    old = f"{directory}.old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old)
+    os.replace(tmp, directory)
+    shutil.rmtree(old, ignore_errors=True)
+    return rows
+
+
+def export_append(session, spec: Export, directory: str, header: dict) -> tuple[int, int] | None:
+    # Returns (rows appended, rows rewritten), or None when the export can no
+    # longer be patched and has to be rewritten.
+    columns = spec.columns()
+    if (header.get("format") != FORMAT or header.get("byteorder") != sys.byteorder
+            or [c["name"] for c in header["columns"]] != [name for name, _, _ in columns]
+            or header.get("loaded_at") != _loaded_at(session, spec.name)
+            or "dimensions_watermark" not in header):
+        return None
+    last_key = header["last_key"]
+    exported = session.execute(
+        select(func.count()).select_from(spec.model).where(spec.key <= last_key)).scalar()
+    if last_key is not None and exported != header["rows"]:
+        return None  # rows were deleted (reconcile) since the export
+
+    watermark = datetime.fromisoformat(header["watermark"]) if header.get("watermark") else None
+    exported_dimensions = header["dimensions_watermark"]
+    dimensions_watermark = _dimensions_watermark(session, spec)
+    key_name = spec.key.key
+    encoders = {}
+    for c in header["columns"]:
+        dictionary = None
+        if c["type"] == "dict":
+            with open(os.path.join(directory, f"{c['name']}.dict.json")) as f:
+                dictionary = json.load(f)
+        encoders[c["name"]] = _Encoder(c["type"], dictionary)
+
+    rewritten = 0
+    # Facts that changed, and facts whose film, store or customer attributes did.
+    stale = [spec.model.last_update > watermark] if watermark is not None else []
+    stale += [table.c.last_update > exported_dimensions if exported_dimensions else table.c.last_update.isnot(None)
+              for table in spec.tables()]
+    if stale and last_key is not None:
+        changed = session.execute(
+            spec.query().where(or_(*stale), spec.key <= last_key).order_by(spec.key)).all()
+        if changed:
+            with ColumnarTable(directory) as table:
+                keys = table.column(key_name)
+                positions = [bisect_left(keys, row._mapping[key_name]) for row in changed]
+                del keys
+            for name, _, kind in columns:
+                encoder = encoders[name]
+                size = encoder.values.itemsize
+                with open(os.path.join(directory, _column_file(name)), "r+b") as f:
+                    for pos, row in zip(positions, changed):
+                        f.seek(pos * size)
+                        array(encoder.values.typecode, [encoder.encode(row._mapping[name])]).tofile(f)
+            rewritten = len(changed)
+            stamps = [r.last_update for r in changed if r.last_update is not None]
+            if stamps:
+                watermark = max(stamps + ([watermark] if watermark else []))
+
+    appended = 0
+    new_rows = session.execute(spec.query().where(spec.key > (last_key or 0)).order_by(spec.key))
+    files = {name: open(os.path.join(directory, _column_file(name)), "ab") for name, _, _ in columns}
+    try:
+        # Drops rows an interrupted append wrote past the header's row count.
+        for name, encoder in encoders.items():
+            files[name].truncate(header["rows"] * encoder.values.itemsize)
+        for chunk in new_rows.partitions(CHUNK):
+            watermark = _encode_chunk(list(encoders.values()), chunk, watermark)
+            last_key = chunk[-1]._mapping[key_name]
+            for name, encoder in encoders.items():
+                encoder.values.tofile(files[name])
+                del encoder.values[:]
+            appended += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+
+    for name, encoder in encoders.items():
+        if encoder.kind == "dict":
+            _write_json(os.path.join(directory, f"{name}.dict.json"), encoder.dictionary)
+    # The header goes last: readers trust its row count.
+    _write_json(os.path.join(directory, "header.json"), dict(
+        header, rows=header["rows"] + appended, last_key=last_key, watermark=_isoformat(watermark),
+        dimensions_watermark=_isoformat(dimensions_watermark)))
+    return appended, rewritten
+
+
+def export_columnar(output: str = "columnar", tables: list[str] | None = None, full: bool = False) -> dict:
+    # Appends to an existing export where possible, otherwise writes it anew.
+    unknown = set(tables or ()) - set(EXPORTS)
+    if unknown:
+        raise ValueError(f"Unknown table(s): {', '.join(sorted(unknown))}")
+    os.makedirs(output, exist_ok=True)
+    session = get_sqlite_session()
+    results = {}
+    try:
+        for name, spec in EXPORTS.items():
+            if tables and name not in tables:
+                continue
+            started = time.perf_counter()
+            directory = os.path.join(output, name)
+            header_path = os.path.join(directory, "header.json")
+            appended = None
+            # Partitioned facts are read through a view over all their files.
+            with partitions.view(session, {name: (None, None)}):
+                if not full and os.path.exists(header_path):
+                    with open(header_path) as f:
+                        appended = export_append(session, spec, directory, json.load(f))
+                if appended is None:
+                    rows = export_full(session, spec, directory)
+            if appended is None:
+                print(f"Exported {name}: {rows} rows in {time.perf_counter() - started:.2f}s")
+            else:
+                rows = appended[0]
+                print(f"Appended {name}: {appended[0]} new rows, {appended[1]} rewritten "
+                      f"in {time.perf_counter() - started:.2f}s")
+            results[name] = rows
+    finally:
+        session.close()
+    return results
+
+
+class ColumnarTable:
+    # Read side of an export directory. column() returns a memoryview over
+    # the mmapped file (typed per the header); strings() decodes a
+    # dictionary-encoded column. Views must be released before close().
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "header.json")) as f:
+            self.header = json.load(f)
+        if self.header["format"] != FORMAT or self.header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{directory}: unsupported format or byte order")
+        self.rows = self.header["rows"]
+        self.types = {c["name"]: c["type"] for c in self.header["columns"]}
+        self._maps = {}
+        self._dictionaries = {}
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self.types)
+
+    def column(self, name: str) -> memoryview:
+        kind = self.types[name]
+        typecode = "i" if kind == "dict" else kind
+        if name not in self._maps:
+            path = os.path.join(self.directory, _column_file(name))
+            with open(path, "rb") as f:
+                self._maps[name] = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                                    if os.fstat(f.fileno()).st_size else None)
+        mapped = self._maps[name]
+        if mapped is None:
+            return memoryview(b"").cast(typecode)
+        view = memoryview(mapped).cast(typecode)
+        # The file may hold rows appended after this header was read.
+        return view[:self.rows]
+
+    def dictionary(self, name: str) -> list:
+        if name not in self._dictionaries:
+            with open(os.path.join(self.directory, f"{name}.dict.json")) as f:
+                self._dictionaries[name] = json.load(f)
+        return self._dictionaries[name]
+
+    def strings(self, name: str) -> list:
+        values = self.dictionary(name)
+        return [values[c] if c >= 0 else None for c in self.column(name)]
+
+    def close(self) -> None:
+        for mapped in self._maps.values():
+            if mapped is not None:
+                mapped.close()
+        self._maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,146 @@
+import queue
+import threading
+from contextvars import copy_context
+from itertools import islice
+
+from sqlalchemy import func
+
+from database import get_mysql_session
+
+
+def row_pk(row, pk_col) -> int:
+    entity = pk_col.class_
+    if isinstance(row, entity):
+        return getattr(row, pk_col.key)
+    for item in row:
+        if isinstance(item, entity):
+            return getattr(item, pk_col.key)
+    raise ValueError(f"{pk_col} not found in source row")
+
+
+def iter_chunks(rows, chunk_size: int):
+    # Lists of up to chunk_size items of a stream, e.g. a yield_per query.
+    it = iter(rows)
+    while chunk := list(islice(it, chunk_size)):
+        yield chunk
+
+
+def iter_pk_chunks(query, pk_col, chunk_size: int, after: int | None = None,
+                   until: int | None = None):
+    # Keyset pagination on the source primary key: every chunk is a bounded
+    # ORDER BY pk LIMIT n query, so memory stays flat and a chunk boundary is
+    # always a valid resume point.
+    if until is not None:
+        query = query.filter(pk_col <= until)
+    while True:
+        q = query if after is None else query.filter(pk_col > after)
+        rows = q.order_by(pk_col).limit(chunk_size).all()
+        if not rows:
+            return
+        after = row_pk(rows[-1], pk_col)
+        yield rows, after
+
+
+def split_pk_range(low: int, high: int, parts: int) -> list[tuple[int, int]]:
+    # Contiguous inclusive [start, end] ranges covering low..high.
+    parts = max(1, min(parts, high - low + 1))
+    step = (high - low + 1) / parts
+    bounds = [low + round(step * i) for i in range(parts)] + [high + 1]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(parts)]
+
+
+def iter_source_chunks(mysql_session, build_query, pk_col, chunk_size: int,
+                       after: int | None = None, parallelism: int = 1, ordered: bool = False,
+                       url: str | None = None):
+    # Yields (rows, checkpoint_pk). checkpoint_pk is the highest PK such that
+    # every source row at or below it has been yielded once this chunk is
+    # written, which is what a resumable loader may record. Parallel ranges
+    # open their own sessions on url, the source mysql_session reads from.
+    if parallelism <= 1:
+        yield from iter_pk_chunks(build_query(mysql_session), pk_col, chunk_size, after)
+        return
+
+    q = mysql_session.query(func.min(pk_col), func.max(pk_col))
+    if after is not None:
+        q = q.filter(pk_col > after)
+    low, high = q.one()
+    if low is None:
+        return
+
+    ranges = split_pk_range(low, high, parallelism)
+    yield from _iter_parallel(build_query, pk_col, chunk_size, after, ranges, ordered, url)
+
+
+def _iter_parallel(build_query, pk_col, chunk_size, after, ranges, ordered, url=None):
+    stop = threading.Event()
+    # Ordered mode gives each range its own queue and drains them in PK order;
+    # unordered mode shares one queue so the writer takes whatever is ready.
+    if ordered:
+        queues = [queue.Queue(maxsize=2) for _ in ranges]
+    else:
+        shared = queue.Queue(maxsize=2 * len(ranges))
+        queues = [shared] * len(ranges)
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(i, start, end):
+        # Separate pooled connection per range.
+        session = get_mysql_session(url=url)
+        try:
+            chunks = iter_pk_chunks(build_query(session), pk_col, chunk_size, start - 1, end)
+            for rows, last_pk in chunks:
+                if not put(queues[i], (i, rows, last_pk, None)):
+                    return
+            put(queues[i], (i, None, None, None))
+        except Exception as exc:
+            put(queues[i], (i, None, None, exc))
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=copy_context().run, args=(produce, i, start, end), daemon=True)
+               for i, (start, end) in enumerate(ranges)]
+    for t in threads:
+        t.start()
+
+    progress = [None] * len(ranges)
+    done = [False] * len(ranges)
+
+    def checkpoint():
+        safe = after
+        for i, (start, end) in enumerate(ranges):
+            if done[i]:
+                safe = end
+                continue
+            if progress[i] is not None:
+                safe = progress[i]
+            break
+        return safe
+
+    try:
+        current = 0
+        while not all(done):
+            if ordered:
+                while done[current]:
+                    current += 1
+                item = queues[current].get()
+            else:
+                item = queues[0].get()
+            i, rows, last_pk, error = item
+            if error is not None:
+                raise error
+            if rows is None:
+                done[i] = True
+                continue
+            progress[i] = last_pk
+            yield rows, checkpoint()
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
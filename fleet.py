@@ -0,0 +1,158 @@
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from datetime import datetime
+
+from sqlalchemy import inspect, func
+
+from config import BATCH_SIZE, CHUNK_SIZE, SYNC_WORKERS, SOURCES, FLEET_WORKERS
+from database import tenant, get_sqlite_engine, get_sqlite_session, dispose_target
+from keycache import KeyCache
+from models_sqlite import SyncRun, SyncState
+from sync import init_db, full_load, incremental
+
+# Syncs many tenant schemas, each into its own SQLite file, in one process:
+# tenants run on a bounded pool, each in a context (database.tenant) that
+# routes its stages to its source and target. Sources on the same MySQL
+# server share one connection pool. Tenants that were synced longest ago
+# (or never) go first.
+
+# Buffer a tenant's printed output goes to while it syncs.
+_output = ContextVar("fleet_output", default=None)
+
+
+class _TenantOutput:
+    # Stands in for sys.stdout during the fleet run, so the prints of
+    # concurrent tenants do not interleave.
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        buffer = _output.get()
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+class Tenant:
+    def __init__(self, name: str, source: str, target: str):
+        self.name = name
+        self.source = source
+        # A plain path is a SQLite file.
+        self.target = target if "://" in target else f"sqlite:///{target}"
+
+
+def load_manifest(path: str) -> list[Tenant]:
+    with open(path) as f:
+        entries = json.load(f)
+    tenants = []
+    for i, entry in enumerate(entries):
+        missing = [k for k in ("name", "source", "target") if not entry.get(k)]
+        if missing:
+            raise ValueError(f"Tenant {i} in {path} lacks {', '.join(missing)}")
+        tenants.append(Tenant(entry["name"], entry["source"], entry["target"]))
+    names = [t.name for t in tenants]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate tenant name(s) in {path}: {', '.join(duplicates)}")
+    return tenants
+
+
+def last_synced(t: Tenant) -> datetime | None:
+    # Start of the tenant's latest successful sync run; None when it has
+    # never been synced (or its target is not initialized).
+    with tenant(t.source, t.target):
+        try:
+            if not inspect(get_sqlite_engine()).has_table(SyncRun.__tablename__):
+                return None
+            session = get_sqlite_session()
+            try:
+                return session.query(func.max(SyncRun.started_at)).filter(SyncRun.status == "ok").scalar()
+            finally:
+                session.close()
+        finally:
+            dispose_target()
+
+
+def sync_tenant(t: Tenant, full: bool, batch_size: int, chunk_size: int, workers: int,
+                synced_at: datetime | None) -> dict:
+    buffer = io.StringIO()
+    _output.set(buffer)
+    started = time.perf_counter()
+    result = {"tenant": t.name, "action": "full-load" if full else "incremental",
+              "last_synced": synced_at.isoformat(timespec="seconds") if synced_at else None}
+    with tenant(t.source, t.target):
+        try:
+            if not inspect(get_sqlite_engine()).has_table(SyncState.__tablename__):
+                # New tenant: initialize its target and load it.
+                result["action"] = "init+full-load"
+                init_db()
+                full = True
+            if full:
+                full_load(batch_size=batch_size, chunk_size=chunk_size, workers=workers, keys=KeyCache())
+            else:
+                incremental(batch_size=batch_size, chunk_size=chunk_size, workers=workers, keys=KeyCache())
+            result["status"] = "ok"
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = f"{type(e).__name__}: {e}"
+            result["output"] = buffer.getvalue().splitlines()
+        finally:
+            dispose_target()
+    result["seconds"] = round(time.perf_counter() - started, 4)
+    return result
+
+
+def fleet(manifest_path: str, full: bool = False, tenant_workers: int = FLEET_WORKERS,
+          batch_size: int = BATCH_SIZE, chunk_size: int = CHUNK_SIZE, workers: int = SYNC_WORKERS,
+          report_path: str | None = None) -> dict:
+    # Runs incremental (or with full, full_load) for every tenant of the
+    # manifest, tenant_workers at a time, each with workers stage threads.
+    # A failing tenant is reported and does not stop the others.
+    if SOURCES:
+        raise ValueError("fleet syncs one source per tenant; unset SYNC_SOURCES")
+    started = time.perf_counter()
+    tenants = load_manifest(manifest_path)
+    synced = {t.name: last_synced(t) for t in tenants}
+    # Never synced first, then oldest sync first; the pool starts them in order.
+    order = sorted(tenants, key=lambda t: (synced[t.name] is not None, synced[t.name] or datetime.min))
+
+    stdout = sys.stdout
+    sys.stdout = _TenantOutput(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, tenant_workers)) as pool:
+            futures = [pool.submit(copy_context().run, sync_tenant, t, full, batch_size, chunk_size, workers,
+                                   synced[t.name])
+                       for t in order]
+            results = [f.result() for f in futures]
+    finally:
+        sys.stdout = stdout
+
+    failed = [r for r in results if r["status"] != "ok"]
+    report = {
+        "generated_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "mode": "full-load" if full else "incremental",
+        "tenants": results,
+        "ok": len(results) - len(failed),
+        "failed": len(failed),
+        "seconds": round(time.perf_counter() - started, 4),
+    }
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    print(f"{'tenant':<24} {'action':<15} {'status':<7} {'seconds':>8}  last synced")
+    for r in results:
+        print(f"{r['tenant']:<24} {r['action']:<15} {r['status']:<7} "
+              f"{r['seconds']:8.2f}  {r['last_synced'] or 'never'}")
+        if "error" in r:
+            print(f"  {r['error'].splitlines()[0]}")
+    print(f"Fleet {report['mode']}: {report['ok']} of {len(results)} tenants synced in "
+          f"{report['seconds']:.2f}s ({tenant_workers} at a time)")
+    if failed:
+        raise RuntimeError(f"{len(failed)} tenant(s) failed: {', '.join(r['tenant'] for r in failed)}")
+    return report
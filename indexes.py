@@ -0,0 +1,95 @@
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import inspect, select, Index, MetaData
+
+from database import sqlite_write_lock
+from models_sqlite import BaseSQLite, IndexAdvice
+
+# Copies of the tables advised indexes are attached to, so that they stay out
+# of BaseSQLite.metadata (and create_all()).
+_advised_metadata = MetaData()
+
+
+def advised_indexes(conn) -> tuple[list[Index], set[str]]:
+    # Changes applied by advise-indexes: (indexes to add, declared index names
+    # to leave out).
+    if not inspect(conn).has_table(IndexAdvice.__tablename__):
+        return [], set()
+    added, dropped = [], set()
+    for name, table_name, columns, action in conn.execute(
+            select(IndexAdvice.name, IndexAdvice.table_name, IndexAdvice.columns, IndexAdvice.action)
+            .order_by(IndexAdvice.name)):
+        if action == "drop":
+            dropped.add(name)
+        elif table_name in BaseSQLite.metadata.tables:
+            table = _advised_metadata.tables.get(table_name)
+            if table is None:
+                table = BaseSQLite.metadata.tables[table_name].to_metadata(_advised_metadata)
+            added.append(Index(name, *(table.c[c] for c in columns.split(","))))
+    return added, dropped
+
+
+def secondary_indexes(tables: set[str] | None = None, conn=None):
+    # The Index() objects declared in models_sqlite.py; given a connection,
+    # adjusted by the changes advise-indexes applied. UNIQUE constraints are
+    # part of the table definition and are not touched here.
+    added, dropped = advised_indexes(conn) if conn is not None else ([], set())
+    for table in BaseSQLite.metadata.sorted_tables:
+        if tables is None or table.name in tables:
+            yield from sorted((ix for ix in table.indexes if ix.name not in dropped), key=lambda ix: ix.name)
+            yield from (ix for ix in added if ix.table.name == table.name)
+
+
+def existing_index_names(conn) -> set[str]:
+    inspector = inspect(conn)
+    return {ix["name"] for table in inspector.get_table_names()
+            for ix in inspector.get_indexes(table)}
+
+
+def drop_secondary_indexes(engine, tables: set[str] | None = None) -> int:
+    dropped = 0
+    with sqlite_write_lock, engine.begin() as conn:
+        existing = existing_index_names(conn)
+        for index in secondary_indexes(tables, conn):
+            if index.name in existing:
+                index.drop(conn)
+                dropped += 1
+    print(f"Dropped {dropped} secondary indexes for the load")
+    return dropped
+
+
+def build_secondary_indexes(engine, tables: set[str] | None = None) -> int:
+    # Creates every declared index that is missing, in one transaction, with a
+    # progress line per index. Indexes that already exist are skipped, so this
+    # is also the repair step after an interrupted deferred load. Declared
+    # indexes advise-indexes dropped are dropped again (create_all() brings
+    # them back with a new table).
+    started = time.perf_counter()
+    with sqlite_write_lock, engine.begin() as conn:
+        existing = existing_index_names(conn)
+        _, dropped = advised_indexes(conn)
+        for table in BaseSQLite.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in dropped and index.name in existing and (tables is None or table.name in tables):
+                    index.drop(conn)
+        missing = [ix for ix in secondary_indexes(tables, conn) if ix.name not in existing]
+        for i, index in enumerate(missing, 1):
+            index_started = time.perf_counter()
+            index.create(conn)
+            print(f"Built index {i}/{len(missing)} {index.name} "
+                  f"in {time.perf_counter() - index_started:.2f}s")
+    if missing:
+        print(f"Rebuilt {len(missing)} indexes in {time.perf_counter() - started:.2f}s")
+    return len(missing)
+
+
+@contextmanager
+def deferred_indexes(engine, tables: set[str] | None = None):
+    # Drops the secondary indexes, runs the load, then rebuilds them whether
+    # or not the load succeeded.
+    drop_secondary_indexes(engine, tables)
+    try:
+        yield
+    finally:
+        build_secondary_indexes(engine, tables)
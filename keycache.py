@@ -0,0 +1,112 @@
+import os
+import pickle
+import threading
+
+from sqlalchemy import func
+
+from models_sqlite import DimFilm, DimActor, DimCategory, DimStore, DimCustomer
+from shards import STRIDE
+
+
+# dimension name -> (model, natural id column, surrogate key column)
+DIMENSIONS = {
+    "film": (DimFilm, DimFilm.film_id, DimFilm.film_key),
+    "actor": (DimActor, DimActor.actor_id, DimActor.actor_key),
+    "category": (DimCategory, DimCategory.category_id, DimCategory.category_key),
+    "store": (DimStore, DimStore.store_id, DimStore.store_key),
+    "customer": (DimCustomer, DimCustomer.customer_id, DimCustomer.customer_key),
+}
+
+
+def dimension_of(model) -> str | None:
+    for name, (dim_model, _, _) in DIMENSIONS.items():
+        if dim_model is model:
+            return name
+    return None
+
+
+def fingerprint(sqlite_session, dimension: str) -> tuple:
+    # Cheap summary of a dimension table; any insert, delete or update
+    # through the loaders changes at least one of these.
+    model, _, key_col = DIMENSIONS[dimension]
+    return tuple(sqlite_session.query(func.count(), func.max(key_col), func.max(model.last_update)).one())
+
+
+class KeyCache:
+    # Natural id -> surrogate key maps for the dimension tables, shared by the
+    # bridge and fact loaders of one run. Each map is read from SQLite the
+    # first time it is asked for and is then kept current by the dimension
+    # loaders via update(), so it is never rescanned within the run.
+    #
+    # With a path, loaded maps are pickled by save() and reused by the next
+    # run as long as the table's fingerprint still matches.
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._maps: dict[str, dict[int, int]] = {}
+        self._stored: dict[str, tuple] = {}
+        self.scans = 0
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self._stored = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                self._stored = {}
+
+    def get(self, sqlite_session, dimension: str) -> dict[int, int]:
+        with self._lock:
+            if dimension in self._maps:
+                return self._maps[dimension]
+
+            stored = self._stored.pop(dimension, None)
+            if stored is not None and stored[0] == fingerprint(sqlite_session, dimension):
+                self._maps[dimension] = stored[1]
+                return stored[1]
+
+            _, id_col, key_col = DIMENSIONS[dimension]
+            mapping = {int(i): k for i, k in sqlite_session.query(id_col, key_col).all()}
+            self._maps[dimension] = mapping
+            self.scans += 1
+            return mapping
+
+    def update(self, dimension: str, pairs) -> None:
+        # pairs are (natural id, surrogate key) rows that were just committed.
+        # Maps that were never loaded stay unloaded; they are read when needed.
+        pairs = list(pairs)
+        if not pairs:
+            return
+        with self._lock:
+            mapping = self._maps.get(dimension)
+            if mapping is not None:
+                mapping.update((int(i), k) for i, k in pairs)
+            self._stored.pop(dimension, None)
+
+    def reset(self, dimension: str, shard=None) -> None:
+        # The dimension table was emptied and is being reloaded, or with shard
+        # only that shard's rows of it (shards.py).
+        with self._lock:
+            mapping = self._maps.get(dimension)
+            if shard is None:
+                self._maps[dimension] = {}
+            elif mapping is not None:
+                self._maps[dimension] = {i: k for i, k in mapping.items()
+                                         if not shard.offset <= i < shard.offset + STRIDE}
+            self._stored.pop(dimension, None)
+
+    def invalidate(self, dimension: str | None = None) -> None:
+        with self._lock:
+            for name in [dimension] if dimension else list(DIMENSIONS):
+                self._maps.pop(name, None)
+                self._stored.pop(name, None)
+
+    def save(self, sqlite_session) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            state = {name: (fingerprint(sqlite_session, name), mapping)
+                     for name, mapping in self._maps.items()}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
@@ -0,0 +1,207 @@
+import json
+import statistics
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from database import get_sqlite_engine, get_sqlite_session, sqlite_write_lock
+from models_sqlite import SyncRun
+
+PHASES = ("extract", "transform", "load")
+
+_local = threading.local()
+
+
+class StageMetrics:
+    # Time per phase and row counts for one stage. Phases nest: time spent in
+    # an inner phase (say a batch flush inside the transform loop) is charged
+    # to the inner phase only, so the three phases add up to at most the
+    # stage's wall time.
+    def __init__(self, stage: str | None):
+        self.stage = stage
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.rows_read = 0
+        self.rows_written = 0
+        self.rows_skipped = 0
+        self.bytes_written = None
+        self.peak_rss_mb = None
+        self.started_at = datetime.utcnow()
+        self.elapsed = 0.0
+        self.status = "ok"
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name: str):
+        frame = [time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - frame[0]
+            self.seconds[name] += elapsed - frame[1]
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def extract(self, iterable):
+        # Iterates iterable, charging the time spent waiting for each item
+        # (source round trips, cursor fetches) to the extract phase.
+        it = iter(iterable)
+        while True:
+            with self.phase("extract"):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, read: int = 0, written: int = 0, skipped: int = 0) -> None:
+        self.rows_read += read
+        self.rows_written += written
+        self.rows_skipped += skipped
+
+    def as_dict(self) -> dict:
+        return {
+            "stage": self.stage,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "seconds": round(self.elapsed, 4),
+            "extract_seconds": round(self.seconds["extract"], 4),
+            "transform_seconds": round(self.seconds["transform"], 4),
+            "load_seconds": round(self.seconds["load"], 4),
+            "rows_read": self.rows_read,
+            "rows_written": self.rows_written,
+            "rows_skipped": self.rows_skipped,
+            "bytes_written": self.bytes_written,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
+
+
+def current() -> StageMetrics:
+    # The metrics of the stage running on this thread. Outside a measured
+    # stage a detached instance is returned and simply discarded.
+    metrics = getattr(_local, "metrics", None)
+    return metrics if metrics is not None else StageMetrics(None)
+
+
+def peak_rss_mb() -> float | None:
+    # Process-wide high-water mark; Linux reports KiB, macOS bytes.
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def database_bytes() -> int:
+    with get_sqlite_engine().connect() as conn:
+        page_count = conn.exec_driver_sql("PRAGMA page_count").scalar()
+        page_size = conn.exec_driver_sql("PRAGMA page_size").scalar()
+    return page_count * page_size
+
+
+@contextmanager
+def measure(stage: str):
+    # Makes a StageMetrics current for the calling thread while the stage
+    # runs. bytes_written is the growth of the SQLite file over the stage,
+    # which overlaps with other stages when several run concurrently.
+    metrics = StageMetrics(stage)
+    size_before = database_bytes()
+    started = time.perf_counter()
+    _local.metrics = metrics
+    try:
+        yield metrics
+    except BaseException:
+        metrics.status = "failed"
+        raise
+    finally:
+        _local.metrics = None
+        metrics.elapsed = time.perf_counter() - started
+        metrics.bytes_written = max(0, database_bytes() - size_before)
+        metrics.peak_rss_mb = peak_rss_mb()
+
+
+def save_run(command: str, stages: list[StageMetrics], json_lines: bool = False) -> str:
+    # Appends one sync_run row per stage and optionally prints each stage as
+    # a JSON line. Returns the run id shared by those rows.
+    run_id = uuid.uuid4().hex
+    rows = [dict(s.as_dict(), run_id=run_id, command=command) for s in stages]
+    if json_lines:
+        for row in rows:
+            print(json.dumps(row))
+    if not rows:
+        return run_id
+
+    SyncRun.__table__.create(get_sqlite_engine(), checkfirst=True)
+    session = get_sqlite_session()
+    try:
+        with sqlite_write_lock:
+            for row in rows:
+                row["started_at"] = datetime.fromisoformat(row["started_at"])
+            session.execute(SyncRun.__table__.insert(), rows)
+            session.commit()
+    finally:
+        session.close()
+    return run_id
+
+
+def throughput(run: SyncRun) -> float | None:
+    if not run.rows_written or not run.seconds:
+        return None
+    return run.rows_written / run.seconds
+
+
+def stats(runs: int = 10, threshold: float = 0.2, command: str | None = None) -> list[tuple[str, str]]:
+    # Prints rows/s per stage over the last runs and flags stages whose latest
+    # throughput is more than threshold below the median of the earlier runs.
+    # Runs that wrote no rows carry no throughput and are left out.
+    SyncRun.__table__.create(get_sqlite_engine(), checkfirst=True)
+    session = get_sqlite_session()
+    try:
+        q = session.query(SyncRun).filter(SyncRun.status == "ok")
+        if command:
+            q = q.filter(SyncRun.command == command)
+        history = q.order_by(SyncRun.started_at, SyncRun.id).all()
+    finally:
+        session.close()
+
+    if not history:
+        print("No sync runs recorded yet")
+        return []
+
+    series: dict[tuple[str, str], list[float]] = {}
+    for run in history:
+        rate = throughput(run)
+        if rate is not None:
+            series.setdefault((run.command, run.stage), []).append(rate)
+
+    regressed = []
+    for cmd in sorted({c for c, _ in series}):
+        print(f"{cmd} (rows/s, oldest -> newest, last {runs} runs)")
+        for (c, stage), rates in sorted(series.items()):
+            if c != cmd:
+                continue
+            rates = rates[-runs:]
+            trend = " ".join(f"{r:,.0f}" for r in rates)
+            flag = ""
+            if len(rates) > 1:
+                baseline = statistics.median(rates[:-1])
+                change = rates[-1] / baseline - 1
+                flag = f"  {change:+.0%} vs median"
+                if change < -threshold:
+                    flag += "  REGRESSED"
+                    regressed.append((c, stage))
+            print(f"  {stage:<22} {trend}{flag}")
+
+    if regressed:
+        print(f"{len(regressed)} stage(s) regressed more than {threshold:.0%}")
+    else:
+        print(f"No stage regressed more than {threshold:.0%}")
+    return regressed
@@ -1,6 +1,6 @@
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy import (Column, Integer, Date, Boolean, String, DateTime, 
-                        UniqueConstraint, Index, Float)
+                        UniqueConstraint, Index, Float, LargeBinary)
 from datetime import datetime
 
 
@@ -14,6 +14,40 @@ class SyncState(BaseSQLite):
     table_name = Column(String(64), nullable=False, unique=True)
     last_synced_at = Column(DateTime, nullable=True) 
 
+class LoadCheckpoint(BaseSQLite):
+    # Progress of the current full load per target table. Chunks commit
+    # together with last_pk, so a resumed load continues after it.
+    __tablename__ = "load_checkpoint"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String(64), nullable=False, unique=True)
+    last_pk = Column(Integer, nullable=True)
+    rows_loaded = Column(Integer, nullable=False, default=0)
+    completed = Column(Boolean, nullable=False, default=False)
+    watermark = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+class SyncRun(BaseSQLite):
+    # Metrics of one stage of a full-load/incremental run; rows of the same
+    # run share run_id.
+    __tablename__ = "sync_run"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_id = Column(String(32), nullable=False)
+    command = Column(String(32), nullable=False)
+    stage = Column(String(64), nullable=False)
+    status = Column(String(16), nullable=False)
+    started_at = Column(DateTime, nullable=False)
+    seconds = Column(Float, nullable=False)
+    extract_seconds = Column(Float, nullable=False)
+    transform_seconds = Column(Float, nullable=False)
+    load_seconds = Column(Float, nullable=False)
+    rows_read = Column(Integer, nullable=False)
+    rows_written = Column(Integer, nullable=False)
+    rows_skipped = Column(Integer, nullable=False)
+    bytes_written = Column(Integer, nullable=True)
+    peak_rss_mb = Column(Float, nullable=True)
+
+Index("ix_sync_run_command_stage", SyncRun.command, SyncRun.stage, SyncRun.started_at)
+
 class DimDate(BaseSQLite):
     __tablename__ = "dim_date"
 
@@ -117,12 +151,15 @@ class FactRental(BaseSQLite):
 
     staff_id = Column(Integer, nullable=False)
     rental_duration_days = Column(Integer, nullable=True)
+    # Source last_update; export-columnar appends the rows it moved past.
+    last_update = Column(DateTime, nullable=True)
 
 Index("ix_fact_rental_rental_id", FactRental.rental_id)
 Index("ix_fact_rental_date_key_rented", FactRental.date_key_rented)
 Index("ix_fact_rental_store_key", FactRental.store_key)
 Index("ix_fact_rental_customer_key", FactRental.customer_key)
 Index("ix_fact_rental_film_key", FactRental.film_key)
+Index("ix_fact_rental_last_update", FactRental.last_update)
 
 
 class FactPayment(BaseSQLite):
@@ -139,11 +176,87 @@ class FactPayment(BaseSQLite):
 
     staff_id = Column(Integer, nullable=False)
     amount = Column(Float, nullable=False)
+    # The rental paid for, when the source has one; links payments to films.
+    rental_id = Column(Integer, nullable=True)
+    last_update = Column(DateTime, nullable=True)
 
 Index("ix_fact_payment_payment_id", FactPayment.payment_id)
 Index("ix_fact_payment_date_key_paid", FactPayment.date_key_paid)
 Index("ix_fact_payment_store_key", FactPayment.store_key)
 Index("ix_fact_payment_customer_key", FactPayment.customer_key)
 Index("ix_fact_payment_staff_id", FactPayment.staff_id)
+Index("ix_fact_payment_last_update", FactPayment.last_update)
+
+
 
 
+# Summary tables kept current by the fact loaders (see aggregates.py).
+class AggStoreDayRevenue(BaseSQLite):
+    __tablename__ = "agg_store_day_revenue"
+    date_key = Column(Integer, primary_key=True)
+    store_key = Column(Integer, primary_key=True)
+    payments = Column(Integer, nullable=False)
+    amount_cents = Column(Integer, nullable=False)
+
+
+class AggStoreDayRentals(BaseSQLite):
+    __tablename__ = "agg_store_day_rentals"
+    date_key = Column(Integer, primary_key=True)
+    store_key = Column(Integer, primary_key=True)
+    rentals = Column(Integer, nullable=False)
+
+
+class AggCategoryDayRentals(BaseSQLite):
+    __tablename__ = "agg_category_day_rentals"
+    date_key = Column(Integer, primary_key=True)
+    category_key = Column(Integer, primary_key=True)
+    rentals = Column(Integer, nullable=False)
+
+
+class AggOpenRentals(BaseSQLite):
+    __tablename__ = "agg_open_rentals"
+    store_key = Column(Integer, primary_key=True)
+    rentals = Column(Integer, nullable=False)
+
+
+class FactPartition(BaseSQLite):
+    # Partition files of the fact tables (see partitions.py): the period
+    # (yyyy or yyyymm) of their rows and the range of natural ids they hold.
+    # A frozen file is read-only and opened as immutable.
+    __tablename__ = "fact_partition"
+    table_name = Column(String(64), primary_key=True)
+    period = Column(Integer, primary_key=True)
+    min_id = Column(Integer, nullable=False)
+    max_id = Column(Integer, nullable=False)
+    frozen = Column(Boolean, nullable=False, default=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class FactKeySequence(BaseSQLite):
+    # Last surrogate key handed out per partitioned fact table, so that keys
+    # stay unique across its partition files (see partitions.py).
+    __tablename__ = "fact_key_sequence"
+    table_name = Column(String(64), primary_key=True)
+    last_key = Column(Integer, nullable=False)
+
+
+class QueryCache(BaseSQLite):
+    # Stored results of queries.py functions (see querycache.py).
+    __tablename__ = "query_cache"
+    cache_key = Column(String(255), primary_key=True)
+    query_name = Column(String(64), nullable=False)
+    token = Column(String(512), nullable=False)
+    result = Column(LargeBinary, nullable=False)
+    bytes = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+
+class IndexAdvice(BaseSQLite):
+    # Index changes applied by advise-indexes (see advisor.py). indexes.py
+    # keeps "add" rows alongside the declared indexes and leaves "drop" rows out.
+    __tablename__ = "index_advice"
+    name = Column(String(128), primary_key=True)
+    table_name = Column(String(64), nullable=False)
+    columns = Column(String(512), nullable=False)
+    action = Column(String(8), nullable=False)
+    applied_at = Column(DateTime, nullable=False)
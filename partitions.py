@@ -0,0 +1,534 @@
+import os
+import stat
+from contextlib import contextmanager
+from datetime import date, datetime
+from urllib.parse import quote
+
+from sqlalchemy import select, delete, func, or_, inspect, event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+
+import metrics
+from bulk import BatchWriter
+from config import BATCH_SIZE, FACT_PARTITIONS, PARTITION_DIR
+from database import _target_url, get_file_engine, get_sqlite_session, dispose_file, sqlite_write_lock
+from models_sqlite import FactRental, FactPayment, FactPartition, FactKeySequence
+
+# With SYNC_FACT_PARTITIONS the fact rows live in one SQLite file per month
+# or year of their date key (<dir>/fact_rental_200507.db, ...) instead of
+# the main database, whose fact tables stay empty. The fact_partition table
+# in the main database lists the files with the range of natural ids each
+# holds, so a lookup by id opens only the files that can have it. Surrogate
+# keys come from fact_key_sequence in the main database, so they are unique
+# across the files, and a row moved to another period keeps its key.
+#
+# Loaders attach the partitions they write to the main session's connection,
+# so the rows commit in one transaction with the aggregates, fact_partition
+# and the load checkpoint (SQLite commits attached files atomically). SQLite
+# attaches at most MAX_ATTACHED files per connection: a transaction that
+# needs more commits what it wrote so far first and says so. Each of those
+# commits leaves the aggregates matching the rows, but not the watermark or
+# load checkpoint, so a run that fails later writes those rows again. The
+# partitions are detached when the connection goes back to the pool. One
+# connection cannot be shared across threads, so the files of a batch are
+# written one after the other. Readers attach the partitions they need to their
+# connection and see them through TEMP views named like the fact tables
+# (view()); date filters keep reads within the limit, wider ones copy the
+# rest first.
+#
+# A frozen partition is read-only on disk and attached as immutable, so
+# SQLite skips its locking; loaders leave the rows of frozen periods alone.
+GRAIN = FACT_PARTITIONS
+if GRAIN not in (None, "month", "year"):
+    raise ValueError(f"SYNC_FACT_PARTITIONS must be 'month' or 'year', got {GRAIN!r}")
+
+# fact table -> (model, date key column choosing the partition, natural key column)
+PARTITIONED = {
+    "fact_rental": (FactRental, "date_key_rented", "rental_id"),
+    "fact_payment": (FactPayment, "date_key_paid", "payment_id"),
+}
+MAX_ATTACHED = 10
+IN_BATCH = 500
+
+# Partition files whose fact table was created by this process.
+_created = set()
+
+
+def enabled(model) -> bool:
+    return GRAIN is not None and model.__tablename__ in PARTITIONED
+
+
+def period_of(date_key: int | None) -> int:
+    # yyyymmdd -> yyyy or yyyymm; rows without a date go to period 0.
+    if date_key is None:
+        return 0
+    return date_key // 10000 if GRAIN == "year" else date_key // 100
+
+
+def bounds(period: int) -> tuple[int, int]:
+    # First and last date key a period can hold.
+    if period == 0:
+        return 0, 0
+    if GRAIN == "year":
+        return period * 10000 + 101, period * 10000 + 1231
+    return period * 100 + 1, period * 100 + 31
+
+
+def in_periods(column, periods):
+    return or_(*(column.between(*bounds(p)) for p in periods))
+
+
+def directory() -> str:
+    if PARTITION_DIR:
+        return PARTITION_DIR
+    return f"{os.path.splitext(make_url(_target_url()).database)[0]}_partitions"
+
+
+def path(table_name: str, period: int) -> str:
+    return os.path.abspath(os.path.join(directory(), f"{table_name}_{period}.db"))
+
+
+def _uri(table_name: str, period: int, frozen: bool) -> str:
+    # Frozen files are opened read-only and immutable.
+    mode = "ro&immutable=1" if frozen else "rwc"
+    return f"file:{quote(path(table_name, period))}?mode={mode}"
+
+
+def engine(table_name: str, period: int, frozen: bool = False):
+    eng = get_file_engine(f"sqlite:///{_uri(table_name, period, frozen)}&uri=true")
+    key = (_target_url(), table_name, period)
+    if not frozen and key not in _created:
+        os.makedirs(directory(), exist_ok=True)
+        # The fact table with its indexes and natural-key constraint.
+        PARTITIONED[table_name][0].__table__.create(eng, checkfirst=True)
+        _created.add(key)
+    return eng
+
+
+def _dispose(table_name: str, period: int) -> None:
+    for frozen in (False, True):
+        dispose_file(f"sqlite:///{_uri(table_name, period, frozen)}&uri=true")
+    _created.discard((_target_url(), table_name, period))
+
+
+def registry(sqlite_session, table_name: str | None = None) -> list[FactPartition]:
+    if GRAIN is None:
+        return []
+    if not inspect(sqlite_session.connection()).has_table(FactPartition.__tablename__):
+        # Databases created before partitioning existed.
+        FactPartition.__table__.create(sqlite_session.connection())
+    query = sqlite_session.query(FactPartition)
+    if table_name is not None:
+        query = query.filter(FactPartition.table_name == table_name)
+    return query.order_by(FactPartition.table_name, FactPartition.period).all()
+
+
+def _holding(parts, ids) -> list[tuple]:
+    # (partition, ids in its range) for every partition that may hold some of ids.
+    found = []
+    for p in parts:
+        inside = [i for i in ids if p.min_id <= i <= p.max_id]
+        if inside:
+            found.append((p, inside))
+    return found
+
+
+def _chunks(values, size: int = IN_BATCH):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _schema(table_name: str, period: int) -> str:
+    return f"{table_name}_{period}"
+
+
+def _in(schema: str) -> dict:
+    # Execution options running a statement on the fact table of an attached partition.
+    return {"schema_translate_map": {None: schema}}
+
+
+def _release(dbapi_conn, record) -> None:
+    # Pool checkin, once the transaction has ended: detach what _reserve attached.
+    for schema in record.info.pop("partitions", ()):
+        if dbapi_conn is not None:
+            dbapi_conn.execute(f"DETACH DATABASE {schema}")
+
+
+def _reserved(sqlite_session) -> set:
+    return sqlite_session.connection().info.get("partitions", set())
+
+
+def _reserve(sqlite_session, table_name: str, periods) -> None:
+    # Attaches the partitions of periods to the session's connection for
+    # writing. If they do not fit next to those attached already, the
+    # transaction is committed first, which detaches those.
+    pool = sqlite_session.connection().engine.pool
+    if not event.contains(pool, "checkin", _release):
+        event.listen(pool, "checkin", _release)
+    wanted = {_schema(table_name, p): p for p in periods}
+    if len(_reserved(sqlite_session) | wanted.keys()) > MAX_ATTACHED:
+        print(f"Committing the {table_name} rows written so far: "
+              f"the transaction needs more than {MAX_ATTACHED} partitions")
+        sqlite_session.commit()
+    conn = sqlite_session.connection()
+    held = conn.info.setdefault("partitions", set())
+    for schema, period in wanted.items():
+        if schema not in held:
+            engine(table_name, period)
+            conn.exec_driver_sql(f"ATTACH DATABASE ? AS {schema}", (_uri(table_name, period, False),))
+            held.add(schema)
+
+
+def _locate(sqlite_session, model, ids):
+    # (partition, row) for the stored rows of the given natural ids. The
+    # partitions attached for writing are read through the session, so
+    # their uncommitted rows count.
+    table_name = model.__tablename__
+    table = model.__table__
+    key = table.c[PARTITIONED[table_name][2]]
+    reserved = _reserved(sqlite_session)
+    for p, inside in _holding(registry(sqlite_session, table_name), ids):
+        schema = _schema(table_name, p.period)
+        for batch in _chunks(inside):
+            stmt = select(table).where(key.in_(batch))
+            if schema in reserved:
+                rows = sqlite_session.execute(stmt, execution_options=_in(schema)).mappings().all()
+            else:
+                with engine(table_name, p.period, p.frozen).connect() as conn:
+                    rows = conn.execute(stmt).mappings().all()
+            for row in rows:
+                yield p, row
+
+
+def current_rows(sqlite_session, model, ids):
+    for _, row in _locate(sqlite_session, model, ids):
+        yield row
+
+
+def connections(sqlite_session, model, frozen: bool | None = None):
+    # A connection to each partition of model (only the frozen or unfrozen
+    # ones when frozen is given), for reads that are summed over them. They
+    # see committed rows only.
+    for p in registry(sqlite_session, model.__tablename__):
+        if frozen is None or p.frozen == frozen:
+            with engine(p.table_name, p.period, p.frozen).connect() as conn:
+                yield conn
+
+
+def frozen_periods(sqlite_session, model) -> list[int]:
+    return [p.period for p in registry(sqlite_session, model.__tablename__) if p.frozen]
+
+
+def _register(sqlite_session, table_name: str, ranges: dict[int, tuple[int, int]]) -> None:
+    stmt = sqlite_insert(FactPartition.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[FactPartition.table_name, FactPartition.period],
+        set_={"min_id": func.min(FactPartition.min_id, stmt.excluded.min_id),
+              "max_id": func.max(FactPartition.max_id, stmt.excluded.max_id),
+              "updated_at": stmt.excluded.updated_at},
+    )
+    now = datetime.utcnow()
+    sqlite_session.execute(stmt, [dict(table_name=table_name, period=period, min_id=low, max_id=high,
+                                       frozen=False, updated_at=now)
+                                  for period, (low, high) in ranges.items()])
+
+
+def _allocate(sqlite_session, model, n: int) -> int:
+    # Hands out n surrogate keys of model; returns the first.
+    table_name = model.__tablename__
+    if not inspect(sqlite_session.connection()).has_table(FactKeySequence.__tablename__):
+        FactKeySequence.__table__.create(sqlite_session.connection())
+    last = sqlite_session.execute(select(FactKeySequence.last_key)
+                                  .where(FactKeySequence.table_name == table_name)).scalar()
+    if last is None:
+        # Partitions written before the sequence existed.
+        key = list(model.__table__.primary_key.columns)[0]
+        last = max((conn.execute(select(func.max(key))).scalar() or 0
+                    for conn in connections(sqlite_session, model)), default=0)
+    stmt = sqlite_insert(FactKeySequence.__table__).values(table_name=table_name, last_key=last + n)
+    sqlite_session.execute(stmt.on_conflict_do_update(index_elements=[FactKeySequence.table_name],
+                                                      set_={"last_key": stmt.excluded.last_key}))
+    return last + 1
+
+
+class PartitionWriter(BatchWriter):
+    # BatchWriter of a partitioned fact table. Each batch is split by period
+    # and written to the attached partitions, in parts that fit on the
+    # connection together. With conflict_on, rows whose date moved to
+    # another period are deleted from their old partition. Stored rows keep
+    # their surrogate key and new ones get the next keys of the sequence.
+    # Rows of frozen periods (new or stored) are skipped and counted in
+    # self.skipped. on_flush sees only the rows written, one part at a time.
+    def __init__(self, session, model, batch_size: int = BATCH_SIZE,
+                 conflict_on: str | None = None, returning: tuple = (), on_flush=None):
+        super().__init__(session, model, batch_size, conflict_on, returning, on_flush)
+        self.model = model
+        _, self.date_column, self.natural = PARTITIONED[model.__tablename__]
+        self.key = list(self.table.primary_key.columns)[0].name
+        self.frozen = set(frozen_periods(session, model))
+        self.skipped = 0
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        with metrics.current().phase("load"):
+            stored, keys = {}, {}
+            if self.conflict_on is not None:
+                for p, row in _locate(self.session, self.model, [r[self.natural] for r in rows]):
+                    stored[row[self.natural]] = p.period
+                    keys[row[self.natural]] = row[self.key]
+            writable = [r for r in rows if period_of(r[self.date_column]) not in self.frozen
+                        and stored.get(r[self.natural]) not in self.frozen]
+            self.skipped += len(rows) - len(writable)
+            if not writable:
+                return
+            new = [r[self.natural] for r in writable if r[self.natural] not in keys]
+            if new:
+                first = _allocate(self.session, self.model, len(new))
+                keys.update(zip(new, range(first, first + len(new))))
+            writable = [{**r, self.key: keys[r[self.natural]]} for r in writable]
+            if self.stmt is None:
+                self.stmt = self._statement(writable[0].keys())
+
+            # Rows grouped by the partitions they touch, those attached
+            # already first, and written in as few parts as fit.
+            name = self.table.name
+            touching: dict[frozenset, list[dict]] = {}
+            for r in writable:
+                period = period_of(r[self.date_column])
+                touched = frozenset(_schema(name, p) for p in (period, stored.get(r[self.natural], period)))
+                touching.setdefault(touched, []).append(r)
+            held = set(_reserved(self.session))
+            part, schemas = [], set(held)
+            for touched in sorted(touching, key=lambda t: (not t <= held, sorted(t))):
+                if part and len(schemas | touched) > MAX_ATTACHED:
+                    self._write(part, stored)
+                    part, schemas = [], set()
+                part += touching[touched]
+                schemas |= touched
+            self._write(part, stored)
+        self.written += len(writable)
+
+    def _write(self, rows: list[dict], stored: dict) -> None:
+        groups: dict[int, list[dict]] = {}
+        removed: dict[int, list[int]] = {}
+        for r in rows:
+            period = period_of(r[self.date_column])
+            groups.setdefault(period, []).append(r)
+            old = stored.get(r[self.natural], period)
+            if old != period:
+                removed.setdefault(old, []).append(r[self.natural])
+
+        name = self.table.name
+        key = self.table.c[self.natural]
+        _reserve(self.session, name, groups.keys() | removed.keys())
+        if self.on_flush is not None:
+            self.on_flush(rows)
+        for period in groups.keys() | removed.keys():
+            options = _in(_schema(name, period))
+            for batch in _chunks(removed.get(period, [])):
+                self.session.execute(delete(self.table).where(key.in_(batch)), execution_options=options)
+            if period in groups:
+                self.session.execute(self.stmt, groups[period], execution_options=options)
+        _register(self.session, name, {p: (min(r[self.natural] for r in g), max(r[self.natural] for r in g))
+                                       for p, g in groups.items()})
+
+
+def writer(session, model, batch_size: int = BATCH_SIZE, conflict_on: str | None = None,
+           returning: tuple = (), on_flush=None) -> BatchWriter:
+    cls = PartitionWriter if enabled(model) else BatchWriter
+    return cls(session, model, batch_size, conflict_on=conflict_on, returning=returning, on_flush=on_flush)
+
+
+def delete_rows(sqlite_session, model, ids, on_delete=None) -> int:
+    # Deletes the rows of natural ids from unfrozen partitions; returns how
+    # many went. on_delete, if given, is called with the ids found in each
+    # partition just before they are deleted (aggregates.forget()).
+    table = model.__table__
+    key = table.c[PARTITIONED[model.__tablename__][2]]
+    removed = 0
+    for p, inside in _holding(registry(sqlite_session, model.__tablename__), ids):
+        if p.frozen:
+            continue
+        _reserve(sqlite_session, p.table_name, [p.period])
+        options = _in(_schema(p.table_name, p.period))
+        for batch in _chunks(inside):
+            found = sqlite_session.execute(select(key).where(key.in_(batch)), execution_options=options)
+            found = found.scalars().all()
+            if on_delete is not None and found:
+                on_delete(found)
+            removed += sqlite_session.execute(delete(table).where(key.in_(found)),
+                                              execution_options=options).rowcount
+    return removed
+
+
+def reset(sqlite_session, model, scope=None) -> None:
+    # Start of a full load: unfrozen partitions are emptied and unregistered,
+    # or with scope (a shard's rows) emptied of those rows. Frozen ones are
+    # kept. The files stay for the load to refill.
+    if not enabled(model):
+        return
+    for p in registry(sqlite_session, model.__tablename__):
+        if p.frozen:
+            continue
+        _reserve(sqlite_session, p.table_name, [p.period])
+        stmt = delete(model.__table__)
+        if scope is not None:
+            stmt = stmt.where(scope)
+        sqlite_session.execute(stmt, execution_options=_in(_schema(p.table_name, p.period)))
+        if scope is None:
+            sqlite_session.delete(p)
+    sqlite_session.flush()
+
+
+def _columns(table_name: str) -> str:
+    return ", ".join(c.name for c in PARTITIONED[table_name][0].__table__.columns)
+
+
+def _attach(conn, parts) -> list[str]:
+    schemas = []
+    for p in parts:
+        schema = f"{p.table_name}_{p.period}"
+        conn.exec_driver_sql(f"ATTACH DATABASE ? AS {schema}", (_uri(p.table_name, p.period, p.frozen),))
+        schemas.append(schema)
+    return schemas
+
+
+def _detach(conn, schemas) -> None:
+    for schema in schemas:
+        conn.exec_driver_sql(f"DETACH DATABASE {schema}")
+
+
+def _stage(conn, parts, staged: set) -> None:
+    # Copies partitions into TEMP tables (<table>_staged), MAX_ATTACHED at a
+    # time, for reads spanning more partitions than can be attached. The
+    # copy is committed so that the partitions can be detached again.
+    for i in range(0, len(parts), MAX_ATTACHED):
+        batch = parts[i:i + MAX_ATTACHED]
+        schemas = _attach(conn, batch)
+        try:
+            for p, schema in zip(batch, schemas):
+                select_rows = f"SELECT {_columns(p.table_name)} FROM {schema}.{p.table_name}"
+                if p.table_name not in staged:
+                    conn.exec_driver_sql(f"CREATE TEMP TABLE {p.table_name}_staged AS {select_rows}")
+                    staged.add(p.table_name)
+                else:
+                    conn.exec_driver_sql(f"INSERT INTO temp.{p.table_name}_staged {select_rows}")
+            conn.connection.commit()
+        finally:
+            _detach(conn, schemas)
+
+
+@contextmanager
+def view(sqlite_session, ranges: dict[str, tuple[int | None, int | None]]):
+    # Attaches, on the session's connection, the partitions of each table of
+    # ranges whose period overlaps its (start_key, end_key), and shadows the
+    # main table with a TEMP view over them. Past MAX_ATTACHED partitions the
+    # oldest are copied into TEMP tables first, which costs a pass over them.
+    # Not for sessions with uncommitted writes: the copy commits, and SQLite
+    # cannot detach a database read inside a write transaction.
+    ranges = {t: r for t, r in ranges.items() if t in PARTITIONED}
+    if GRAIN is None or not ranges:
+        yield
+        return
+    parts = []
+    for p in registry(sqlite_session):
+        if p.table_name in ranges:
+            low, high = bounds(p.period)
+            start, end = ranges[p.table_name]
+            if (start is None or high >= start) and (end is None or low <= end):
+                parts.append(p)
+    parts.sort(key=lambda p: p.period)
+    overflow = max(0, len(parts) - MAX_ATTACHED)
+
+    conn = sqlite_session.connection()
+    attached, views, staged = [], [], set()
+    try:
+        _stage(conn, parts[:overflow], staged)
+        attached = _attach(conn, parts[overflow:])
+        for table_name in ranges:
+            sources = [f"{p.table_name}_{p.period}.{table_name}" for p in parts[overflow:]
+                       if p.table_name == table_name]
+            if table_name in staged:
+                sources.append(f"temp.{table_name}_staged")
+            conn.exec_driver_sql(f"CREATE TEMP VIEW {table_name} AS " + " UNION ALL ".join(
+                f"SELECT {_columns(table_name)} FROM {source}" for source in sources or [f"main.{table_name}"]))
+            views.append(table_name)
+        yield
+    finally:
+        for table_name in views:
+            conn.exec_driver_sql(f"DROP VIEW temp.{table_name}")
+        for table_name in staged:
+            conn.exec_driver_sql(f"DROP TABLE temp.{table_name}_staged")
+        _detach(conn, attached)
+
+
+def _set_frozen(sqlite_session, p: FactPartition, frozen: bool) -> None:
+    file = path(p.table_name, p.period)
+    with sqlite_write_lock.of(file):
+        _dispose(p.table_name, p.period)
+        mode = os.stat(file).st_mode
+        write = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+        os.chmod(file, mode & ~write if frozen else mode | stat.S_IWUSR)
+        p.frozen = frozen
+        p.updated_at = datetime.utcnow()
+
+
+def freeze(before: date) -> list[FactPartition]:
+    # Makes every partition whose period ended before the given day
+    # read-only. Returns the partitions frozen now.
+    first = period_of(int(before.strftime("%Y%m%d")))
+    session = get_sqlite_session()
+    try:
+        with sqlite_write_lock:
+            frozen = [p for p in registry(session) if not p.frozen and 0 < p.period < first]
+            for p in frozen:
+                _set_frozen(session, p, True)
+            session.commit()
+        return frozen
+    finally:
+        session.close()
+
+
+def thaw(period: int) -> list[FactPartition]:
+    session = get_sqlite_session()
+    try:
+        with sqlite_write_lock:
+            thawed = [p for p in registry(session) if p.frozen and p.period == period]
+            for p in thawed:
+                _set_frozen(session, p, False)
+            session.commit()
+        return thawed
+    finally:
+        session.close()
+
+
+def show(freeze_before: date | None = None, thaw_period: int | None = None) -> list[dict]:
+    # Lists the partitions with their rows and size, after freezing or thawing.
+    if GRAIN is None:
+        print("Fact partitioning is off (set SYNC_FACT_PARTITIONS to month or year)")
+        return []
+    if freeze_before is not None:
+        print(f"Froze {len(freeze(freeze_before))} partition(s) before {freeze_before}")
+    if thaw_period is not None:
+        print(f"Thawed {len(thaw(thaw_period))} partition(s) of {thaw_period}")
+
+    session = get_sqlite_session()
+    listed = []
+    try:
+        for p in registry(session):
+            model = PARTITIONED[p.table_name][0]
+            with engine(p.table_name, p.period, p.frozen).connect() as conn:
+                rows = conn.execute(select(func.count()).select_from(model.__table__)).scalar()
+            listed.append({"table": p.table_name, "period": p.period, "rows": rows,
+                           "bytes": os.path.getsize(path(p.table_name, p.period)), "frozen": p.frozen})
+    finally:
+        session.close()
+
+    print(f"{'table':<14} {'period':>7} {'rows':>10} {'size':>10}  state  ({directory()})")
+    for p in listed:
+        print(f"{p['table']:<14} {p['period']:>7} {p['rows']:>10,} {p['bytes'] / 1024:>8.0f}KB  "
+              f"{'frozen' if p['frozen'] else 'open'}")
+    return listed
@@ -0,0 +1,238 @@
+import statistics
+import time
+from datetime import date
+
+from sqlalchemy import select, func, bindparam, desc, Integer
+
+import partitions
+from database import get_sqlite_session
+from querycache import cache
+from models_sqlite import (
+    DimFilm, DimActor, DimCategory, DimStore, DimCustomer,
+    BridgeFilmActor, BridgeFilmCategory, FactRental, FactPayment, AggStoreDayRevenue,
+)
+
+# Common analytics over the star schema. Each statement is built once, here,
+# with bound parameters: SQLAlchemy compiles it once per engine, and since
+# the SQL text never changes, every pooled sqlite3 connection keeps its
+# prepared statement in its own statement cache. Date filters are ranges on
+# the indexed date_key_* columns (yyyymmdd integers), never functions of
+# them, so SQLite can use the indexes.
+FIRST_KEY = 0
+LAST_KEY = 99991231
+
+_start = bindparam("start_key", type_=Integer)
+_end = bindparam("end_key", type_=Integer)
+_limit = bindparam("limit", type_=Integer)
+
+
+def _month(date_key):
+    # yyyymmdd -> yyyymm
+    return (date_key // 100).label("month")
+
+
+_revenue_by_store = (
+    # Read from the daily aggregate instead of fact_payment.
+    select(_month(AggStoreDayRevenue.date_key), DimStore.store_id, DimStore.city,
+           func.sum(AggStoreDayRevenue.payments).label("payments"),
+           (func.sum(AggStoreDayRevenue.amount_cents) / 100.0).label("revenue"))
+    .join_from(AggStoreDayRevenue, DimStore, AggStoreDayRevenue.store_key == DimStore.store_key)
+    .where(AggStoreDayRevenue.date_key.between(_start, _end))
+    .group_by("month", DimStore.store_id, DimStore.city)
+    .order_by("month", DimStore.store_id)
+)
+
+_revenue_by_month = (
+    select(_month(AggStoreDayRevenue.date_key),
+           func.sum(AggStoreDayRevenue.payments).label("payments"),
+           (func.sum(AggStoreDayRevenue.amount_cents) / 100.0).label("revenue"))
+    .where(AggStoreDayRevenue.date_key.between(_start, _end))
+    .group_by("month")
+    .order_by("month")
+)
+
+_revenue_by_category = (
+    # A payment counts towards every category of the film rented.
+    select(_month(FactPayment.date_key_paid), DimCategory.name.label("category"),
+           func.count().label("payments"), func.round(func.sum(FactPayment.amount), 2).label("revenue"))
+    .join_from(FactPayment, FactRental, FactPayment.rental_id == FactRental.rental_id)
+    .join(BridgeFilmCategory, FactRental.film_key == BridgeFilmCategory.film_key)
+    .join(DimCategory, BridgeFilmCategory.category_key == DimCategory.category_key)
+    .where(FactPayment.date_key_paid.between(_start, _end))
+    .group_by("month", DimCategory.name)
+    .order_by("month", desc("revenue"))
+)
+
+_top_films = (
+    select(DimFilm.film_id, DimFilm.title, DimFilm.rating, func.count().label("rentals"))
+    .join_from(FactRental, DimFilm, FactRental.film_key == DimFilm.film_key)
+    .where(FactRental.date_key_rented.between(_start, _end))
+    .group_by(DimFilm.film_key)
+    .order_by(desc("rentals"), DimFilm.film_id)
+    .limit(_limit)
+)
+
+_customer_lifetime_value = (
+    select(DimCustomer.customer_id, DimCustomer.first_name, DimCustomer.last_name,
+           func.count().label("payments"), func.round(func.sum(FactPayment.amount), 2).label("value"),
+           func.min(FactPayment.date_key_paid).label("first_paid"),
+           func.max(FactPayment.date_key_paid).label("last_paid"))
+    .join_from(FactPayment, DimCustomer, FactPayment.customer_key == DimCustomer.customer_key)
+    .where(FactPayment.date_key_paid.between(_start, _end))
+    .group_by(DimCustomer.customer_key)
+    .order_by(desc("value"), DimCustomer.customer_id)
+    .limit(_limit)
+)
+
+_actor_popularity = (
+    # Rentals of every film the actor appears in.
+    select(DimActor.actor_id, DimActor.first_name, DimActor.last_name,
+           func.count(func.distinct(FactRental.film_key)).label("films"), func.count().label("rentals"))
+    .join_from(FactRental, BridgeFilmActor, FactRental.film_key == BridgeFilmActor.film_key)
+    .join(DimActor, BridgeFilmActor.actor_key == DimActor.actor_key)
+    .where(FactRental.date_key_rented.between(_start, _end))
+    .group_by(DimActor.actor_key)
+    .order_by(desc("rentals"), DimActor.actor_id)
+    .limit(_limit)
+)
+
+
+def _params(start: date | None, end: date | None, limit: int | None = None) -> dict:
+    params = {
+        "start_key": int(start.strftime("%Y%m%d")) if start else FIRST_KEY,
+        "end_key": int(end.strftime("%Y%m%d")) if end else LAST_KEY,
+    }
+    if limit is not None:
+        params["limit"] = limit
+    return params
+
+
+def revenue_by_store(session, start: date | None = None, end: date | None = None, limit: int = 10):
+    return session.execute(_revenue_by_store, _params(start, end)).all()
+
+
+def revenue_by_month(session, start: date | None = None, end: date | None = None, limit: int = 10):
+    return session.execute(_revenue_by_month, _params(start, end)).all()
+
+
+def revenue_by_category(session, start: date | None = None, end: date | None = None, limit: int = 10):
+    return session.execute(_revenue_by_category, _params(start, end)).all()
+
+
+def top_films(session, start: date | None = None, end: date | None = None, limit: int = 10):
+    return session.execute(_top_films, _params(start, end, limit)).all()
+
+
+def customer_lifetime_value(session, start: date | None = None, end: date | None = None, limit: int = 10):
+    return session.execute(_customer_lifetime_value, _params(start, end, limit)).all()
+
+
+def actor_popularity(session, start: date | None = None, end: date | None = None, limit: int = 10):
+    return session.execute(_actor_popularity, _params(start, end, limit)).all()
+
+
+# CLI name -> function; limit applies to the ranked queries only.
+QUERIES = {
+    "revenue-by-store": revenue_by_store,
+    "revenue-by-month": revenue_by_month,
+    "revenue-by-category": revenue_by_category,
+    "top-films": top_films,
+    "customer-lifetime-value": customer_lifetime_value,
+    "actor-popularity": actor_popularity,
+}
+
+# CLI name -> statement, for advise-indexes when no workload was captured
+STATEMENTS = {
+    "revenue-by-store": _revenue_by_store,
+    "revenue-by-month": _revenue_by_month,
+    "revenue-by-category": _revenue_by_category,
+    "top-films": _top_films,
+    "customer-lifetime-value": _customer_lifetime_value,
+    "actor-popularity": _actor_popularity,
+}
+
+# CLI name -> sync_state tables whose watermark invalidates a cached result
+DEPENDS = {
+    "revenue-by-store": ("payment", "store"),
+    "revenue-by-month": ("payment",),
+    "revenue-by-category": ("payment", "rental", "film", "category", "film_category"),
+    "top-films": ("rental", "film"),
+    "customer-lifetime-value": ("payment", "customer"),
+    "actor-popularity": ("rental", "film", "actor", "film_actor"),
+}
+
+# CLI name -> fact tables read, each with whether the date range filters it;
+# only their partitions in range are attached (see partitions.py)
+FACTS = {
+    "revenue-by-store": {},
+    "revenue-by-month": {},
+    "revenue-by-category": {"fact_payment": True, "fact_rental": False},
+    "top-films": {"fact_rental": True},
+    "customer-lifetime-value": {"fact_payment": True},
+    "actor-popularity": {"fact_rental": True},
+}
+
+
+def compute(session, name: str, start: date | None = None, end: date | None = None, limit: int = 10):
+    params = _params(start, end)
+    bounds = (params["start_key"], params["end_key"])
+    with partitions.view(session, {t: bounds if filtered else (None, None)
+                                   for t, filtered in FACTS[name].items()}):
+        return QUERIES[name](session, start, end, limit)
+
+
+def cached(session, name: str, start: date | None = None, end: date | None = None,
+           limit: int = 10) -> tuple[list, str]:
+    # QUERIES[name] through the result cache; returns (rows, where they came
+    # from: "memory", "table" or "computed").
+    return cache.get(session, name, _params(start, end, limit), DEPENDS[name],
+                     lambda: compute(session, name, start, end, limit))
+
+
+def run_query(name: str, start: date | None = None, end: date | None = None, limit: int = 10,
+              repeat: int = 1, use_cache: bool = True) -> list:
+    # Prints the result as a table followed by its timing. With repeat > 1
+    # the query runs that many times on the same session; the first run pays
+    # for compiling and preparing the statement (or fills the cache), the
+    # others show warm timing.
+    if name not in QUERIES:
+        raise ValueError(f"Unknown query {name!r}; choose from {', '.join(QUERIES)}")
+    session = get_sqlite_session()
+    timings = []
+    sources = []
+    try:
+        for _ in range(max(1, repeat)):
+            started = time.perf_counter()
+            if use_cache:
+                rows, source = cached(session, name, start, end, limit)
+            else:
+                rows, source = compute(session, name, start, end, limit), "computed"
+            timings.append((time.perf_counter() - started) * 1000)
+            sources.append(source)
+    finally:
+        session.close()
+
+    if rows:
+        columns = list(rows[0]._fields)
+        table = [[_cell(v) for v in row] for row in rows]
+        widths = [max(len(c), *(len(r[i]) for r in table)) for i, c in enumerate(columns)]
+        print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+        for r in table:
+            print("  ".join(v.rjust(w) if _numeric(v) else v.ljust(w) for v, w in zip(r, widths)))
+
+    timing = f"{len(rows)} rows in {timings[0]:.1f} ms ({sources[0]})"
+    if len(timings) > 1:
+        timing += (f", then median {statistics.median(timings[1:]):.1f} ms over {len(timings) - 1} warm runs "
+                   f"({sources[-1]})")
+    print(timing)
+    return rows
+
+
+def _cell(value) -> str:
+    if isinstance(value, float):
+        return f"{value:,.2f}"
+    return "" if value is None else str(value)
+
+
+def _numeric(text: str) -> bool:
+    return text.replace(",", "").replace(".", "", 1).lstrip("-").isdigit()
@@ -0,0 +1,144 @@
+import json
+import pickle
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import QUERY_CACHE_ENTRIES, QUERY_CACHE_MAX_BYTES, QUERY_CACHE_MAX_AGE
+from database import get_sqlite_engine, sqlite_write_lock
+from models_sqlite import QueryCache, SyncState
+from shards import sync_names
+
+# Results of read queries, valid for as long as the sync_state watermarks of
+# the source tables they depend on stay where they were when the result was
+# computed. Those only move when full-load/incremental commit, so a dashboard
+# re-running the same query pays for one sync_state read and a lookup.
+# Results live in an in-process LRU and in the query_cache table, which later
+# processes (each 'app.py query' run) read as well.
+
+# sync_state row moved by changes that leave the source watermarks alone
+# (reconcile repairs, aggregate rebuilds); every cached result depends on it.
+REPAIR_MARK = "repair"
+
+
+def mark_repaired(sqlite_session) -> None:
+    stmt = sqlite_insert(SyncState.__table__).values(table_name=REPAIR_MARK, last_synced_at=datetime.utcnow())
+    sqlite_session.execute(stmt.on_conflict_do_update(
+        index_elements=[SyncState.table_name],
+        set_={"last_synced_at": stmt.excluded.last_synced_at},
+    ))
+
+
+def token(sqlite_session, tables) -> str:
+    names = sorted({n for table in tables for n in sync_names(table)} | {REPAIR_MARK})
+    marks = dict(sqlite_session.execute(
+        select(SyncState.table_name, SyncState.last_synced_at).where(SyncState.table_name.in_(names))).all())
+    return json.dumps([[name, str(marks.get(name))] for name in names])
+
+
+def _rows(columns, values) -> list:
+    row = namedtuple("Row", columns, rename=True)
+    return [row(*v) for v in values]
+
+
+class ResultCache:
+    # entries and max_bytes bound both the in-process LRU and the table,
+    # evicting least recently used (in memory) or oldest (in the table)
+    # entries first; entries older than max_age seconds are recomputed.
+    def __init__(self, entries: int = QUERY_CACHE_ENTRIES, max_bytes: int = QUERY_CACHE_MAX_BYTES,
+                 max_age: float = QUERY_CACHE_MAX_AGE, persist: bool = True):
+        self.entries = entries
+        self.max_bytes = max_bytes
+        self.max_age = timedelta(seconds=max_age)
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, tuple] = OrderedDict()
+        self._memory_bytes = 0
+        self._table_ready = False
+
+    def get(self, sqlite_session, name: str, params: dict, tables, compute) -> tuple[list, str]:
+        # Returns (rows, source) where source is "memory", "table" or
+        # "computed". compute() runs the query on a miss.
+        key = f"{name}:{json.dumps(params, sort_keys=True, default=str)}"
+        current = token(sqlite_session, tables)
+        now = datetime.utcnow()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] == current and now - entry[1] < self.max_age:
+                self._memory.move_to_end(key)
+                return entry[2], "memory"
+
+        if self.persist:
+            self._create_table()
+            stored = sqlite_session.execute(
+                select(QueryCache.token, QueryCache.created_at, QueryCache.result)
+                .where(QueryCache.cache_key == key)).first()
+            if stored is not None and stored.token == current and now - stored.created_at < self.max_age:
+                rows = _rows(*pickle.loads(stored.result))
+                self._remember(key, current, stored.created_at, rows, len(stored.result))
+                return rows, "table"
+
+        result = compute()
+        columns = list(result[0]._fields) if result else []
+        values = [tuple(r) for r in result]
+        blob = pickle.dumps((columns, values), protocol=pickle.HIGHEST_PROTOCOL)
+        rows = _rows(columns, values)
+        self._remember(key, current, now, rows, len(blob))
+        if self.persist:
+            self._store(sqlite_session, key, name, current, blob, now)
+        return rows, "computed"
+
+    def clear(self, sqlite_session=None) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if self.persist and sqlite_session is not None:
+            self._create_table()
+            with sqlite_write_lock:
+                sqlite_session.execute(delete(QueryCache))
+                sqlite_session.commit()
+
+    def _remember(self, key: str, current: str, created: datetime, rows: list, size: int) -> None:
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= old[3]
+            self._memory[key] = (current, created, rows, size)
+            self._memory_bytes += size
+            while self._memory and (len(self._memory) > self.entries or self._memory_bytes > self.max_bytes):
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted[3]
+
+    def _store(self, sqlite_session, key: str, name: str, current: str, blob: bytes, now: datetime) -> None:
+        stmt = sqlite_insert(QueryCache.__table__).values(
+            cache_key=key, query_name=name, token=current, result=blob, bytes=len(blob), created_at=now)
+        with sqlite_write_lock:
+            sqlite_session.execute(stmt.on_conflict_do_update(
+                index_elements=[QueryCache.cache_key],
+                set_={c: stmt.excluded[c] for c in ("token", "result", "bytes", "created_at")},
+            ))
+            sqlite_session.execute(delete(QueryCache).where(QueryCache.created_at < now - self.max_age))
+            kept = total = 0
+            evict = []
+            for cache_key, size in sqlite_session.execute(
+                    select(QueryCache.cache_key, QueryCache.bytes).order_by(QueryCache.created_at.desc())):
+                kept += 1
+                total += size
+                if kept > self.entries or total > self.max_bytes:
+                    evict.append(cache_key)
+            if evict:
+                sqlite_session.execute(delete(QueryCache).where(QueryCache.cache_key.in_(evict)))
+            sqlite_session.commit()
+
+    def _create_table(self) -> None:
+        if not self._table_ready:
+            QueryCache.__table__.create(get_sqlite_engine(), checkfirst=True)
+            self._table_ready = True
+
+
+# Shared by queries.cached() in this process.
+cache = ResultCache()
@@ -0,0 +1,438 @@
+import time
+
+from sqlalchemy import select, func, cast, delete, bindparam, or_, Integer
+
+import aggregates
+import partitions
+import querycache
+from config import BATCH_SIZE
+from database import get_mysql_session, get_sqlite_session, sqlite_write_lock
+from keycache import KeyCache, DIMENSIONS, dimension_of
+from shards import Shard, SHARDS, LOCAL
+from sqlexpr import day_key, stamp, cents, row_hash
+
+from models_sqlite import (
+    DimFilm, DimActor, DimCategory, DimStore, DimCustomer,
+    BridgeFilmActor, BridgeFilmCategory, FactRental, FactPayment,
+)
+from models_mysql import (
+    Actor, Category, Store, Customer, Address, City, Country,
+    FilmActor, FilmCategory, Film, Language, Rental, Payment, Staff, Inventory,
+)
+from sync import (
+    film_record, actor_record, category_record, store_record, customer_record,
+    film_source, store_source, customer_source, rental_source, payment_source,
+    rental_transform, payment_transform, DateKeySpan, extend_dim_date,
+)
+
+# Compares each target table with its source as a tree of checksums over
+# primary-key ranges: both sides reduce a range to (row count, SUM(CRC32(row)))
+# in SQL, and only ranges whose checksums differ are split further. At
+# LEAF_SIZE ids the per-row hashes are compared, which names the missing,
+# extra and changed rows; only those rows are then re-read from the source.
+FANOUT = 16
+LEAF_SIZE = 512
+IN_BATCH = 500
+
+
+class TableSpec:
+    # source()/target(shard) return a select whose first `identity` columns
+    # name a row on both sides, the first of them an integer range key, plus
+    # that key's column for range filters. The remaining columns are the
+    # content compared. target(shard) reads only shard's rows, with their ids
+    # as the shard's source has them.
+    def __init__(self, name: str, source, target, identity: int = 1, model=None,
+                 build_query=None, source_pk=None, transform=None, date_columns: tuple[str, ...] = ()):
+        self.name = name
+        self.source = source
+        self.target = target
+        self.identity = identity
+        self.model = model
+        self.build_query = build_query
+        self.source_pk = source_pk
+        self.transform = transform
+        self.date_columns = date_columns
+
+
+def _local(shard: Shard, column):
+    return shard.local(column).label(column.key)
+
+
+def _scoped(stmt, shard: Shard, column):
+    scope = shard.scope(column)
+    return stmt if scope is None else stmt.where(scope)
+
+
+def _scoped_bridge(stmt, shard: Shard, column):
+    # Bridge rows whose film is gone belong to no shard, so every shard sees them.
+    scope = shard.scope(column)
+    return stmt if scope is None else stmt.where(or_(scope, column.is_(None)))
+
+
+def _dim_spec(name, model, source_cols, target_cols, build_query, source_pk, record):
+    natural = getattr(model, source_pk.key)
+    return TableSpec(
+        name,
+        source=lambda: (source_cols(), source_pk),
+        target=lambda shard: (_scoped(target_cols(shard), shard, natural), shard.local(natural)),
+        model=model, build_query=build_query, source_pk=source_pk,
+        transform=lambda keys, session, shard: lambda row: record(row, shard),
+    )
+
+
+SPECS = [
+    _dim_spec(
+        "dim_film", DimFilm,
+        lambda: select(Film.film_id, Film.title, Film.rating, Film.length, Film.release_year,
+                       Language.name.label("language"), stamp(Film.last_update).label("stamp"))
+        .join_from(Film, Language, Film.language_id == Language.language_id),
+        lambda shard: select(_local(shard, DimFilm.film_id), DimFilm.title, DimFilm.rating, DimFilm.length,
+                             DimFilm.release_year, DimFilm.language, stamp(DimFilm.last_update).label("stamp")),
+        film_source, Film.film_id, lambda row, shard: film_record(*row, shard),
+    ),
+    _dim_spec(
+        "dim_actor", DimActor,
+        lambda: select(Actor.actor_id, Actor.first_name, Actor.last_name,
+                       stamp(Actor.last_update).label("stamp")),
+        lambda shard: select(_local(shard, DimActor.actor_id), DimActor.first_name, DimActor.last_name,
+                             stamp(DimActor.last_update).label("stamp")),
+        lambda session: session.query(Actor), Actor.actor_id, actor_record,
+    ),
+    _dim_spec(
+        "dim_category", DimCategory,
+        lambda: select(Category.category_id, Category.name, stamp(Category.last_update).label("stamp")),
+        lambda shard: select(_local(shard, DimCategory.category_id), DimCategory.name,
+                             stamp(DimCategory.last_update).label("stamp")),
+        lambda session: session.query(Category), Category.category_id, category_record,
+    ),
+    _dim_spec(
+        "dim_store", DimStore,
+        lambda: select(Store.store_id, City.city, Country.country, stamp(Store.last_update).label("stamp"))
+        .join_from(Store, Address, Store.address_id == Address.address_id)
+        .join(City, Address.city_id == City.city_id)
+        .join(Country, City.country_id == Country.country_id),
+        lambda shard: select(_local(shard, DimStore.store_id), DimStore.city, DimStore.country,
+                             stamp(DimStore.last_update).label("stamp")),
+        store_source, Store.store_id, lambda row, shard: store_record(row[0], row[2], row[3], shard),
+    ),
+    _dim_spec(
+        "dim_customer", DimCustomer,
+        lambda: select(Customer.customer_id, Customer.first_name, Customer.last_name, Customer.active,
+                       City.city, Country.country, stamp(Customer.last_update).label("stamp"))
+        .join_from(Customer, Address, Customer.address_id == Address.address_id)
+        .join(City, Address.city_id == City.city_id)
+        .join(Country, City.country_id == Country.country_id),
+        lambda shard: select(_local(shard, DimCustomer.customer_id), DimCustomer.first_name,
+                             DimCustomer.last_name, cast(DimCustomer.active, Integer).label("active"),
+                             DimCustomer.city, DimCustomer.country, stamp(DimCustomer.last_update).label("stamp")),
+        customer_source, Customer.customer_id, lambda row, shard: customer_record(row[0], row[2], row[3], shard),
+    ),
+    TableSpec(
+        "bridge_film_actor",
+        source=lambda: (select(FilmActor.film_id, FilmActor.actor_id), FilmActor.film_id),
+        # Outer joins, so a row whose film or actor is gone shows up as extra.
+        target=lambda shard: (
+            _scoped_bridge(select(_local(shard, DimFilm.film_id), _local(shard, DimActor.actor_id))
+                           .select_from(BridgeFilmActor)
+                           .outerjoin(DimFilm, BridgeFilmActor.film_key == DimFilm.film_key)
+                           .outerjoin(DimActor, BridgeFilmActor.actor_key == DimActor.actor_key),
+                           shard, DimFilm.film_id),
+            shard.local(DimFilm.film_id),
+        ),
+        identity=2, model=BridgeFilmActor,
+    ),
+    TableSpec(
+        "bridge_film_category",
+        source=lambda: (select(FilmCategory.film_id, FilmCategory.category_id), FilmCategory.film_id),
+        target=lambda shard: (
+            _scoped_bridge(select(_local(shard, DimFilm.film_id), _local(shard, DimCategory.category_id))
+                           .select_from(BridgeFilmCategory)
+                           .outerjoin(DimFilm, BridgeFilmCategory.film_key == DimFilm.film_key)
+                           .outerjoin(DimCategory, BridgeFilmCategory.category_key == DimCategory.category_key),
+                           shard, DimFilm.film_id),
+            shard.local(DimFilm.film_id),
+        ),
+        identity=2, model=BridgeFilmCategory,
+    ),
+    TableSpec(
+        "fact_rental",
+        source=lambda: (
+            select(Rental.rental_id, day_key(Rental.rental_date).label("date_key_rented"),
+                   day_key(Rental.return_date).label("date_key_returned"), Inventory.film_id,
+                   Inventory.store_id, Rental.customer_id, Rental.staff_id,
+                   stamp(Rental.last_update).label("stamp"))
+            .join_from(Rental, Inventory, Rental.inventory_id == Inventory.inventory_id),
+            Rental.rental_id,
+        ),
+        # Outer joins, so a fact whose dimension row is gone still shows up
+        # (as changed) instead of vanishing from the comparison.
+        target=lambda shard: (
+            _scoped(select(_local(shard, FactRental.rental_id), FactRental.date_key_rented,
+                           FactRental.date_key_returned, _local(shard, DimFilm.film_id),
+                           _local(shard, DimStore.store_id), _local(shard, DimCustomer.customer_id),
+                           FactRental.staff_id, stamp(FactRental.last_update).label("stamp"))
+                    .select_from(FactRental)
+                    .outerjoin(DimFilm, FactRental.film_key == DimFilm.film_key)
+                    .outerjoin(DimStore, FactRental.store_key == DimStore.store_key)
+                    .outerjoin(DimCustomer, FactRental.customer_key == DimCustomer.customer_key),
+                    shard, FactRental.rental_id),
+            shard.local(FactRental.rental_id),
+        ),
+        model=FactRental, build_query=rental_source, source_pk=Rental.rental_id,
+        transform=rental_transform, date_columns=("date_key_rented", "date_key_returned"),
+    ),
+    TableSpec(
+        "fact_payment",
+        source=lambda: (
+            select(Payment.payment_id, day_key(Payment.payment_date).label("date_key_paid"),
+                   Payment.customer_id, Staff.store_id, Payment.staff_id,
+                   cents(Payment.amount).label("cents"), Payment.rental_id,
+                   stamp(Payment.last_update).label("stamp"))
+            .join_from(Payment, Staff, Payment.staff_id == Staff.staff_id),
+            Payment.payment_id,
+        ),
+        target=lambda shard: (
+            _scoped(select(_local(shard, FactPayment.payment_id), FactPayment.date_key_paid,
+                           _local(shard, DimCustomer.customer_id), _local(shard, DimStore.store_id),
+                           FactPayment.staff_id, cents(FactPayment.amount).label("cents"),
+                           _local(shard, FactPayment.rental_id), stamp(FactPayment.last_update).label("stamp"))
+                    .select_from(FactPayment)
+                    .outerjoin(DimCustomer, FactPayment.customer_key == DimCustomer.customer_key)
+                    .outerjoin(DimStore, FactPayment.store_key == DimStore.store_key),
+                    shard, FactPayment.payment_id),
+            shard.local(FactPayment.payment_id),
+        ),
+        model=FactPayment, build_query=payment_source, source_pk=Payment.payment_id,
+        transform=payment_transform, date_columns=("date_key_paid",),
+    ),
+]
+
+
+class TableDiff:
+    def __init__(self, name: str):
+        self.name = name
+        self.missing: set = set()
+        self.extra: set = set()
+        self.changed: set = set()
+        self.queries = 0
+        self.hashes = 0
+
+    def in_sync(self) -> bool:
+        return not (self.missing or self.extra or self.changed)
+
+
+def _summary(session, stmt, diff: TableDiff):
+    sub = stmt.subquery()
+    cols = list(sub.c)
+    row = session.execute(select(func.count(), func.sum(row_hash(cols)), func.min(cols[0]),
+                                 func.max(cols[0])).select_from(sub)).one()
+    diff.queries += 1
+    diff.hashes += 1
+    return int(row[0]), int(row[1] or 0), row[2], row[3]
+
+
+def _buckets(session, stmt, pk, low: int, high: int, width: int, diff: TableDiff) -> dict:
+    sub = stmt.where(pk.between(low, high)).subquery()
+    cols = list(sub.c)
+    bucket = ((cols[0] - low) // width).label("bucket")
+    rows = session.execute(
+        select(bucket, func.count(), func.sum(row_hash(cols))).group_by(bucket)
+    ).all()
+    diff.queries += 1
+    diff.hashes += len(rows)
+    return {int(b): (int(n), int(h or 0)) for b, n, h in rows}
+
+
+def _leaf(session, stmt, identity: int, where, diff: TableDiff) -> dict:
+    sub = stmt.where(where).subquery()
+    cols = list(sub.c)
+    rows = session.execute(select(*cols[:identity], row_hash(cols))).all()
+    diff.queries += 1
+    diff.hashes += len(rows)
+    return {tuple(r[:identity]) if identity > 1 else r[0]: int(r[-1]) for r in rows}
+
+
+def diff_table(spec: TableSpec, mysql_session, sqlite_session,
+               fanout: int = FANOUT, leaf_size: int = LEAF_SIZE, shard: Shard = LOCAL) -> TableDiff:
+    diff = TableDiff(shard.name(spec.name))
+    src_stmt, src_pk = spec.source()
+    tgt_stmt, tgt_pk = spec.target(shard)
+
+    src = _summary(mysql_session, src_stmt, diff)
+    tgt = _summary(sqlite_session, tgt_stmt, diff)
+    if src[:2] == tgt[:2]:
+        return diff
+
+    if spec.identity > 1:
+        # Bridge rows whose film is gone have no range key; all of them are extra.
+        diff.extra.update(_leaf(sqlite_session, tgt_stmt, spec.identity, tgt_pk.is_(None), diff).keys())
+    bounds = [b for b in (src[2], src[3], tgt[2], tgt[3]) if b is not None]
+    pending = [(int(min(bounds)), int(max(bounds)))] if bounds else []
+    while pending:
+        low, high = pending.pop()
+        if high - low + 1 <= leaf_size:
+            a = _leaf(mysql_session, src_stmt, spec.identity, src_pk.between(low, high), diff)
+            b = _leaf(sqlite_session, tgt_stmt, spec.identity, tgt_pk.between(low, high), diff)
+            diff.missing.update(a.keys() - b.keys())
+            diff.extra.update(b.keys() - a.keys())
+            diff.changed.update(k for k in a.keys() & b.keys() if a[k] != b[k])
+            continue
+
+        width = -(-(high - low + 1) // fanout)
+        a = _buckets(mysql_session, src_stmt, src_pk, low, high, width, diff)
+        b = _buckets(sqlite_session, tgt_stmt, tgt_pk, low, high, width, diff)
+        for bucket in a.keys() | b.keys():
+            if a.get(bucket) != b.get(bucket):
+                start = low + bucket * width
+                pending.append((start, min(high, start + width - 1)))
+    return diff
+
+
+def _chunks(values, size: int = IN_BATCH):
+    values = sorted(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def repair_rows(spec: TableSpec, diff: TableDiff, mysql_session, sqlite_session, keys: KeyCache,
+                batch_size: int = BATCH_SIZE, shard: Shard = LOCAL) -> tuple[int, int, int]:
+    # Re-reads missing and changed rows through the loaders' own queries and
+    # record builders and upserts them; deletes rows gone from the source.
+    dimension = dimension_of(spec.model)
+    transform = spec.transform(keys, sqlite_session, shard)
+    natural = getattr(spec.model, spec.source_pk.key)
+    written = skipped = removed = 0
+
+    with sqlite_write_lock:
+        writer = partitions.writer(sqlite_session, spec.model, batch_size, conflict_on=spec.source_pk.key,
+                                   returning=DIMENSIONS[dimension][1:] if dimension else (),
+                                   on_flush=aggregates.tracker(sqlite_session, spec.model))
+        dates = DateKeySpan()
+        for ids in _chunks(diff.missing | diff.changed):
+            for row in spec.build_query(mysql_session).filter(spec.source_pk.in_(ids)):
+                record = transform(row)
+                if record is None:
+                    skipped += 1
+                    continue
+                dates.add(*(record[c] for c in spec.date_columns))
+                writer.add(record)
+        writer.flush()
+        extend_dim_date(sqlite_session, dates)
+        written = writer.written
+
+        for ids in _chunks(diff.extra):
+            ids = [shard.key(i) for i in ids]
+            if partitions.enabled(spec.model):
+                removed += partitions.delete_rows(sqlite_session, spec.model, ids, on_delete=lambda found:
+                                                  aggregates.forget(sqlite_session, spec.model, found))
+            else:
+                aggregates.forget(sqlite_session, spec.model, ids)
+                removed += sqlite_session.execute(delete(spec.model).where(natural.in_(ids))).rowcount
+        sqlite_session.commit()
+
+    if dimension:
+        keys.update(dimension, writer.returned)
+        if removed:
+            keys.invalidate(dimension)
+    return written, removed, skipped
+
+
+def repair_bridge(spec: TableSpec, diff: TableDiff, sqlite_session, keys: KeyCache,
+                  shard: Shard = LOCAL) -> tuple[int, int, int]:
+    # A bridge row has no content beyond its two keys, so only missing and
+    # extra pairs occur.
+    table = spec.model.__table__
+    left, right = list(table.primary_key.columns)
+    film_map = keys.get(sqlite_session, "film")
+    other_map = keys.get(sqlite_session, right.name[:-len("_key")])
+
+    def mapped(pairs):
+        rows = []
+        for film_id, other_id in pairs:
+            fk, ok = film_map.get(shard.key(film_id)), other_map.get(shard.key(other_id))
+            if fk is not None and ok is not None:
+                rows.append({"b_left": fk, "b_right": ok})
+        return rows
+
+    inserts = mapped(diff.missing)
+    deletes = mapped(pair for pair in diff.extra if None not in pair)
+    if any(None in pair for pair in diff.extra):
+        # Rows whose film or other dimension row is gone have no ids to map.
+        other_key = DIMENSIONS[right.name[:-len("_key")]][2]
+        orphans = select(left, right).where(or_(left.not_in(select(DimFilm.film_key)),
+                                                right.not_in(select(other_key))))
+        deletes += [{"b_left": fk, "b_right": ok} for fk, ok in sqlite_session.execute(orphans)]
+    with sqlite_write_lock:
+        if deletes:
+            sqlite_session.execute(
+                delete(table).where(left == bindparam("b_left"), right == bindparam("b_right")), deletes)
+        if inserts:
+            sqlite_session.execute(
+                table.insert().values({left.name: bindparam("b_left"), right.name: bindparam("b_right")}),
+                inserts)
+        if spec.model is BridgeFilmCategory:
+            aggregates.relink_categories(sqlite_session, [(r["b_left"], r["b_right"]) for r in inserts],
+                                         [(r["b_left"], r["b_right"]) for r in deletes])
+        sqlite_session.commit()
+    return len(inserts), len(deletes), len(diff.missing) - len(inserts)
+
+
+def reconcile_shard(shard: Shard, tables: list[str] | None, dry_run: bool, batch_size: int, keys: KeyCache,
+                    mysql_session, sqlite_session, results: dict) -> None:
+    for spec in SPECS:
+        if tables and spec.name not in tables:
+            continue
+        # Partitioned facts are compared through a view over all their files.
+        with partitions.view(sqlite_session, {spec.name: (None, None)}):
+            diff = diff_table(spec, mysql_session, sqlite_session, shard=shard)
+        results[diff.name] = diff
+        traffic = (f"{diff.queries} checksum queries, {diff.hashes} hashes "
+                   f"(~{diff.hashes * 16 / 1024:.1f} KB)")
+        if diff.in_sync():
+            print(f"{diff.name}: in sync ({traffic})")
+            continue
+
+        print(f"{diff.name}: {len(diff.missing)} missing, {len(diff.extra)} extra, "
+              f"{len(diff.changed)} changed ({traffic})")
+        if dry_run:
+            continue
+        if spec.identity > 1:
+            written, removed, skipped = repair_bridge(spec, diff, sqlite_session, keys, shard)
+        else:
+            written, removed, skipped = repair_rows(spec, diff, mysql_session, sqlite_session,
+                                                    keys, batch_size, shard)
+        with sqlite_write_lock:
+            querycache.mark_repaired(sqlite_session)
+            sqlite_session.commit()
+        note = f", {skipped} skipped (dimension not loaded)" if skipped else ""
+        print(f"  repaired: {written} written, {removed} deleted{note}")
+
+
+def reconcile(tables: list[str] | None = None, dry_run: bool = False,
+              batch_size: int = BATCH_SIZE, keys: KeyCache | None = None) -> dict[str, TableDiff]:
+    # Dimensions come first in SPECS, so facts and bridges are repaired
+    # against up-to-date surrogate keys. Each shard is compared with its own
+    # source; results are keyed by shard.name(table).
+    started = time.perf_counter()
+    keys = keys if keys is not None else KeyCache()
+    unknown = set(tables or ()) - {s.name for s in SPECS}
+    if unknown:
+        raise ValueError(f"Unknown table(s): {', '.join(sorted(unknown))}")
+
+    sqlite_session = get_sqlite_session()
+    results = {}
+    try:
+        for shard in SHARDS:
+            mysql_session = get_mysql_session(url=shard.url)
+            try:
+                reconcile_shard(shard, tables, dry_run, batch_size, keys, mysql_session, sqlite_session,
+                                results)
+            finally:
+                mysql_session.close()
+    finally:
+        sqlite_session.close()
+
+    drifted = sum(1 for d in results.values() if not d.in_sync())
+    action = "found drift in" if dry_run else "repaired"
+    print(f"Reconcile {action} {drifted} of {len(results)} tables in {time.perf_counter() - started:.2f}s")
+    return results
@@ -0,0 +1,95 @@
+import time
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from database import get_mysql_session, get_sqlite_session
+from metrics import measure
+
+
+class Stage:
+    # run(mysql_session, sqlite_session, results) is called once every stage
+    # named in deps has finished; results maps stage name -> return value.
+    # mysql_session reads from source_url (default: MYSQL_URL).
+    def __init__(self, name: str, run, deps: tuple[str, ...] = (), source_url: str | None = None):
+        self.name = name
+        self.run = run
+        self.deps = tuple(deps)
+        self.source_url = source_url
+
+
+def select_stages(stages: list[Stage], names: set[str]) -> list[Stage]:
+    # The named stages only; dependencies on stages that were left out are
+    # dropped, so run_stages() does not wait for them.
+    return [Stage(s.name, s.run, tuple(d for d in s.deps if d in names), s.source_url)
+            for s in stages if s.name in names]
+
+
+def run_stages(stages: list[Stage], workers: int = 1, metrics: list | None = None) -> dict:
+    # metrics, when given, receives a StageMetrics per stage that ran,
+    # including failed ones.
+    by_name = {s.name: s for s in stages}
+    for s in stages:
+        unknown = [d for d in s.deps if d not in by_name]
+        if unknown:
+            raise ValueError(f"Stage {s.name} depends on unknown stage(s): {', '.join(unknown)}")
+
+    results = {}
+    timeline = []
+    pending = list(stages)
+    started_at = time.perf_counter()
+
+    def execute(stage):
+        begin = time.perf_counter() - started_at
+        # Each stage gets its own pooled MySQL connection and SQLite session,
+        # so concurrent stages never share a cursor.
+        mysql_session = get_mysql_session(stream_results=True, url=stage.source_url)
+        sqlite_session = get_sqlite_session()
+        try:
+            with measure(stage.name) as stage_metrics:
+                if metrics is not None:
+                    metrics.append(stage_metrics)
+                return stage.run(mysql_session, sqlite_session, results)
+        finally:
+            mysql_session.close()
+            sqlite_session.close()
+            timeline.append((stage.name, begin, time.perf_counter() - started_at))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        running = {}
+        failure = None
+        while pending or running:
+            if failure is None:
+                ready = [s for s in pending if all(d in results for d in s.deps)]
+                for stage in ready:
+                    pending.remove(stage)
+                    # In the caller's context: its tenant and SQLite profile.
+                    running[pool.submit(copy_context().run, execute, stage)] = stage
+            if not running:
+                if failure is None and pending:
+                    names = ", ".join(s.name for s in pending)
+                    raise RuntimeError(f"Dependency cycle between stages: {names}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                except Exception as exc:
+                    if failure is None:
+                        failure = exc
+
+        if failure is not None:
+            raise failure
+
+    print_timeline(timeline, time.perf_counter() - started_at, workers)
+    return results
+
+
+def print_timeline(timeline, total: float, workers: int, width: int = 40) -> None:
+    print(f"Stage timeline: {total:.2f}s wall clock, {workers} worker(s)")
+    scale = width / total if total > 0 else 0
+    for name, begin, end in sorted(timeline, key=lambda t: t[1]):
+        lead = int(begin * scale)
+        bar = max(1, int(end * scale) - lead)
+        print(f"  {name:<22} {begin:7.2f}s -> {end:7.2f}s  |{' ' * lead}{'#' * bar}")
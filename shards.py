@@ -0,0 +1,66 @@
+from sqlalchemy import select
+
+from config import SOURCES
+
+# Sakila split by store across several sources, each tagged with a shard id
+# (SYNC_SOURCES). Natural ids read from shard n are stored as
+# n * STRIDE + id, so the film, store, customer, rental ... ids of different
+# shards never collide in the dim_*/fact_* unique columns, every dim_* row
+# gets its own surrogate key, and the rows of one shard are one id range.
+# Watermarks, checkpoints and stages of shard n are named "<name>@<n>".
+#
+# Without SYNC_SOURCES the single source (MYSQL_URL, or the tenant's in
+# fleet mode) is shard 0: ids are stored as they are and names carry no
+# suffix.
+STRIDE = 10 ** 10
+
+
+class Shard:
+    def __init__(self, number: int, url: str | None):
+        self.number = number
+        self.url = url
+        self.offset = number * STRIDE
+
+    def __repr__(self) -> str:
+        return f"Shard({self.number})"
+
+    def name(self, base: str) -> str:
+        return base if self.number == 0 else f"{base}@{self.number}"
+
+    def key(self, natural_id) -> int | None:
+        # Source id -> id stored in the target.
+        return None if natural_id is None else self.offset + int(natural_id)
+
+    def local(self, column):
+        # Target id column -> source id expression, for comparisons with the source.
+        return column - self.offset if self.offset else column
+
+    def owns(self, column):
+        return column.between(self.offset, self.offset + STRIDE - 1)
+
+    def scope(self, column):
+        # Filter for this shard's rows of a target id column; None when there
+        # is only one source and every row is its.
+        return self.owns(column) if len(SHARDS) > 1 else None
+
+    def others(self, key_column, id_column):
+        # Surrogate keys (key_column) of the rows of other shards, by their id_column.
+        return select(key_column).where(~self.owns(id_column))
+
+
+def _shards() -> list[Shard]:
+    if not SOURCES:
+        return [Shard(0, None)]
+    numbers = [n for n, _ in SOURCES]
+    if min(numbers) < 1 or len(set(numbers)) != len(numbers):
+        raise ValueError(f"SYNC_SOURCES needs distinct shard ids of 1 and up, got {numbers}")
+    return [Shard(n, url) for n, url in sorted(SOURCES)]
+
+
+SHARDS = _shards()
+# Default of the record builders: ids stored unchanged.
+LOCAL = Shard(0, None)
+
+
+def sync_names(base: str) -> list[str]:
+    return [shard.name(base) for shard in SHARDS]
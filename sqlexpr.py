@@ -0,0 +1,54 @@
+from sqlalchemy import func, cast, Integer, String
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+# SQL expressions that must give the same value on the MySQL source and the
+# SQLite target, so results can be compared across the two.
+
+
+class day_key(FunctionElement):
+    # yyyymmdd integer of a DATETIME, the same value as sync.make_date_key().
+    type = Integer()
+    inherit_cache = True
+    name = "day_key"
+
+
+@compiles(day_key)
+def _day_key_sqlite(element, compiler, **kw):
+    return compiler.process(cast(func.strftime("%Y%m%d", *element.clauses), Integer), **kw)
+
+
+@compiles(day_key, "mysql")
+def _day_key_mysql(element, compiler, **kw):
+    return compiler.process(cast(func.date_format(*element.clauses, "%Y%m%d"), Integer), **kw)
+
+
+class stamp(FunctionElement):
+    # A DATETIME as 'yyyymmddhhmmss' text, which SQLite and MySQL format alike.
+    type = String()
+    inherit_cache = True
+    name = "stamp"
+
+
+@compiles(stamp)
+def _stamp_sqlite(element, compiler, **kw):
+    return compiler.process(func.strftime("%Y%m%d%H%M%S", *element.clauses), **kw)
+
+
+@compiles(stamp, "mysql")
+def _stamp_mysql(element, compiler, **kw):
+    return compiler.process(func.date_format(*element.clauses, "%Y%m%d%H%i%s"), **kw)
+
+
+def cents(column):
+    return cast(func.round(column * 100), Integer)
+
+
+def row_hash(columns):
+    # CRC32 of the columns as '|'-separated text; renders as || on SQLite and
+    # concat() on MySQL. SQLite gets crc32() from database._register_functions.
+    parts = [func.coalesce(cast(c, String), "") for c in columns]
+    text = parts[0]
+    for part in parts[1:]:
+        text = text + "|" + part
+    return func.crc32(text)
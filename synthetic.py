@@ -0,0 +1,164 @@
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert, update, bindparam, func, select
+
+from models_mysql import (
+    Base, Language, Country, City, Address, Store, Staff, Film, Actor, Category,
+    FilmActor, FilmCategory, Customer, Inventory, Rental, Payment,
+)
+
+# A local stand-in for the MySQL Sakila source, built from models_mysql.py in a
+# SQLite file. Scale 1 matches the sample database's sizes; the scale factor
+# multiplies rentals and payments only, like a store that keeps its catalogue
+# and customers but accumulates history.
+FILMS = 1000
+ACTORS = 200
+CATEGORIES = 16
+STORES = 2
+CUSTOMERS = 599
+INVENTORY = 4581
+COUNTRIES = 109
+CITIES = 600
+RENTALS = 16044
+HISTORY_DAYS = 730
+
+RATINGS = ("G", "PG", "PG-13", "R", "NC-17")
+
+
+def source_url(path) -> str:
+    return f"sqlite:///{path}"
+
+
+def _batches(rows, size: int = 50000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate_source(path, scale: float = 1.0, seed: int = 1) -> dict[str, int]:
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    # Everything generated is older than any later apply_changes() stamp.
+    stamp = now - timedelta(days=1)
+    rentals = max(1, int(RENTALS * scale))
+    addresses = STORES + CUSTOMERS
+
+    engine = create_engine(source_url(path))
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Language), [dict(language_id=1, name="English", last_update=stamp)])
+        conn.execute(insert(Country), [dict(country_id=i, country=f"Country {i}", last_update=stamp)
+                                       for i in range(1, COUNTRIES + 1)])
+        conn.execute(insert(City), [dict(city_id=i, city=f"City {i}", country_id=1 + i % COUNTRIES,
+                                         last_update=stamp) for i in range(1, CITIES + 1)])
+        conn.execute(insert(Address), [dict(address_id=i, city_id=rng.randint(1, CITIES), last_update=stamp)
+                                       for i in range(1, addresses + 1)])
+        conn.execute(insert(Store), [dict(store_id=i, address_id=i, last_update=stamp)
+                                     for i in range(1, STORES + 1)])
+        conn.execute(insert(Staff), [dict(staff_id=i, store_id=i, last_update=stamp)
+                                     for i in range(1, STORES + 1)])
+        conn.execute(insert(Film), [
+            dict(film_id=i, title=f"FILM {i}", release_year=2006, language_id=1,
+                 rating=rng.choice(RATINGS), length=rng.randint(46, 185), last_update=stamp)
+            for i in range(1, FILMS + 1)
+        ])
+        conn.execute(insert(Actor), [dict(actor_id=i, first_name=f"FIRST{i}", last_name=f"LAST{i}",
+                                          last_update=stamp) for i in range(1, ACTORS + 1)])
+        conn.execute(insert(Category), [dict(category_id=i, name=f"Category {i}", last_update=stamp)
+                                        for i in range(1, CATEGORIES + 1)])
+        conn.execute(insert(FilmActor), [
+            dict(actor_id=a, film_id=f, last_update=stamp)
+            for f in range(1, FILMS + 1)
+            for a in sorted({rng.randint(1, ACTORS) for _ in range(rng.randint(1, 10))})
+        ])
+        conn.execute(insert(FilmCategory), [dict(film_id=f, category_id=rng.randint(1, CATEGORIES),
+                                                 last_update=stamp) for f in range(1, FILMS + 1)])
+        conn.execute(insert(Customer), [
+            dict(customer_id=i, store_id=1 + i % STORES, first_name=f"FIRST{i}", last_name=f"LAST{i}",
+                 active=int(rng.random() > 0.03), address_id=STORES + i, last_update=stamp)
+            for i in range(1, CUSTOMERS + 1)
+        ])
+        conn.execute(insert(Inventory), [dict(inventory_id=i, film_id=rng.randint(1, FILMS),
+                                              store_id=1 + i % STORES, last_update=stamp)
+                                         for i in range(1, INVENTORY + 1)])
+
+        for batch in _batches(_rental_rows(rng, 1, rentals, stamp, HISTORY_DAYS)):
+            conn.execute(insert(Rental), [r for r, _ in batch])
+            conn.execute(insert(Payment), [p for _, p in batch])
+
+    engine.dispose()
+    return {"rental": rentals, "payment": rentals, "film": FILMS, "customer": CUSTOMERS}
+
+
+def _rental_rows(rng, first_id: int, count: int, stamp: datetime, days: int):
+    # One payment per rental, paid when rented. Rentals from the last week
+    # may still be out.
+    for rental_id in range(first_id, first_id + count):
+        rented = stamp - timedelta(days=rng.randint(0, days), seconds=rng.randint(0, 86399))
+        returned = rented + timedelta(days=rng.randint(1, 9))
+        if returned > stamp:
+            returned = None
+        customer_id = rng.randint(1, CUSTOMERS)
+        staff_id = rng.randint(1, STORES)
+        yield (
+            dict(rental_id=rental_id, rental_date=rented, inventory_id=rng.randint(1, INVENTORY),
+                 customer_id=customer_id, return_date=returned, staff_id=staff_id, last_update=stamp),
+            dict(payment_id=rental_id, customer_id=customer_id, staff_id=staff_id, rental_id=rental_id,
+                 amount=rng.choice((0.99, 2.99, 4.99, 5.99, 9.99)), payment_date=rented, last_update=stamp),
+        )
+
+
+def apply_changes(path, ratio: float, seed: int = 2) -> dict[str, int]:
+    # Simulates a day of activity: ratio x rentals new rentals with payments,
+    # the same number of existing rentals returned with a corrected payment,
+    # and ratio x customers/films edited. Every change gets a fresh last_update.
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    engine = create_engine(source_url(path))
+    with engine.begin() as conn:
+        max_rental = conn.execute(select(func.max(Rental.rental_id))).scalar() or 0
+        count = int(max_rental * ratio)
+        touched_customers = int(CUSTOMERS * ratio)
+        touched_films = int(FILMS * ratio)
+
+        for batch in _batches(_rental_rows(rng, max_rental + 1, count, now, 1)):
+            conn.execute(insert(Rental), [r for r, _ in batch])
+            conn.execute(insert(Payment), [p for _, p in batch])
+
+        changed = rng.sample(range(1, max_rental + 1), min(count, max_rental))
+        if changed:
+            conn.execute(
+                update(Rental).where(Rental.rental_id == bindparam("b_id"))
+                .values(return_date=now, last_update=now),
+                [{"b_id": i} for i in changed],
+            )
+            conn.execute(
+                update(Payment).where(Payment.payment_id == bindparam("b_id"))
+                .values(amount=bindparam("b_amount"), last_update=now),
+                [{"b_id": i, "b_amount": rng.choice((1.99, 3.99, 6.99))} for i in changed],
+            )
+        if touched_customers:
+            conn.execute(
+                update(Customer).where(Customer.customer_id == bindparam("b_id"))
+                .values(last_name=bindparam("b_name"), last_update=now),
+                [{"b_id": i, "b_name": f"CHANGED{i}"}
+                 for i in rng.sample(range(1, CUSTOMERS + 1), touched_customers)],
+            )
+        if touched_films:
+            conn.execute(
+                update(Film).where(Film.film_id == bindparam("b_id"))
+                .values(length=bindparam("b_length"), last_update=now),
+                [{"b_id": i, "b_length": rng.randint(46, 185)}
+                 for i in rng.sample(range(1, FILMS + 1), touched_films)],
+            )
+
+    engine.dispose()
+    return {"rental": 2 * count, "payment": 2 * count, "customer": touched_customers, "film": touched_films}
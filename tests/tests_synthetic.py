@@ -0,0 +1,500 @@
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+import pytest
+
+from synthetic import generate_source, apply_changes, source_url
+
+
+def run_cli(args: list[str], env: dict) -> str:
+    p = subprocess.run(["python", "app.py", *args], capture_output=True, text=True, env=env, check=True)
+    return p.stdout + p.stderr
+
+
+def count(db_path: Path, sql: str) -> int:
+    with sqlite3.connect(db_path) as con:
+        return con.execute(sql).fetchone()[0]
+
+
+@pytest.fixture
+def synthetic_env(tmp_path: Path):
+    # Runs against a small generated Sakila stand-in, so no MySQL is needed.
+    source = tmp_path / "sakila_synthetic.db"
+    db_path = tmp_path / "analytics_sakila_test.db"
+    generate_source(source, scale=0.1)
+
+    env = os.environ.copy()
+    env["MYSQL_URL"] = source_url(source)
+    env["SQLITE_URL"] = f"sqlite:///{db_path}"
+    return env, source, db_path
+
+
+def test_full_load_matches_source(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+
+    assert count(db_path, "SELECT COUNT(*) FROM fact_rental") == count(source, "SELECT COUNT(*) FROM rental")
+    assert count(db_path, "SELECT COUNT(*) FROM fact_payment") == count(source, "SELECT COUNT(*) FROM payment")
+    assert count(db_path, "SELECT COUNT(*) FROM dim_customer") == count(source, "SELECT COUNT(*) FROM customer")
+
+
+def test_bulk_profile_load_leaves_durable_pragmas(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    # Loads with the bulk profile, then reads the pragmas of a fresh
+    # connection of the same process.
+    load = ("from database import dispose, get_sqlite_engine\n"
+            "from sync import full_load\n"
+            "full_load(profile='bulk')\n"
+            "dispose()\n"
+            "with get_sqlite_engine().connect() as conn:\n"
+            "    print(*(conn.exec_driver_sql(f'PRAGMA {p}').scalar() for p in ('journal_mode', 'synchronous')))")
+    p = subprocess.run(["python", "-c", load], capture_output=True, text=True, env=env, check=True)
+    assert p.stdout.split()[-2:] == ["delete", "2"]
+
+    with sqlite3.connect(db_path) as con:
+        assert con.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+
+
+def test_incremental_after_changes_validates(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    apply_changes(source, ratio=0.05)
+    run_cli(["incremental"], env)
+
+    assert count(db_path, "SELECT COUNT(*) FROM fact_rental") == count(source, "SELECT COUNT(*) FROM rental")
+    assert count(db_path, "SELECT COUNT(*) FROM dim_customer WHERE last_name LIKE 'CHANGED%'") == \
+        count(source, "SELECT COUNT(*) FROM customer WHERE last_name LIKE 'CHANGED%'")
+
+    out = run_cli(["validate"], env)
+    assert "Validation passed" in out
+
+
+def test_validate_report_flags_only_the_window_with_the_drift(synthetic_env, tmp_path: Path):
+    env, source, db_path = synthetic_env
+    report = tmp_path / "validate.json"
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    # One payment inside the 365-day window but outside the 7- and 30-day ones.
+    since, until = date.today() - timedelta(days=300), date.today() - timedelta(days=60)
+    with sqlite3.connect(source) as con:
+        con.execute("UPDATE payment SET amount = amount + 5 WHERE payment_id = (SELECT MIN(payment_id) "
+                    "FROM payment WHERE payment_date BETWEEN ? AND ?)", (since.isoformat(), until.isoformat()))
+
+    with pytest.raises(subprocess.CalledProcessError) as failed:
+        run_cli(["validate", "--windows", "7,30,365", "--report", str(report)], env)
+    assert "payment total mismatch beyond tolerance (365 days)" in failed.value.stderr
+
+    result = json.loads(report.read_text())
+    assert result["passed"] is False
+    windows = {w["days"]: w for w in result["windows"]}
+    assert sorted(windows) == [7, 30, 365]
+    assert windows[7]["ok"] and windows[30]["ok"]
+    assert not windows[365]["ok"] and not windows[365]["payments"]["ok"] and windows[365]["rentals"]["ok"]
+    assert windows[365]["payments"]["source"] - windows[365]["payments"]["target"] == pytest.approx(5)
+    assert sum(not s["ok"] for s in windows[365]["stores"]) == 1
+
+
+def test_reconcile_repairs_source_deletes(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    with sqlite3.connect(source) as con:
+        con.execute("DELETE FROM rental WHERE rental_id IN (3, 50)")
+        con.execute("UPDATE customer SET first_name = 'SILENT' WHERE customer_id = 5")
+
+    out = run_cli(["reconcile"], env)
+    assert "fact_rental: 0 missing, 2 extra, 0 changed" in out
+    assert "dim_customer: 0 missing, 0 extra, 1 changed" in out
+
+    assert count(db_path, "SELECT COUNT(*) FROM fact_rental") == count(source, "SELECT COUNT(*) FROM rental")
+    assert count(db_path, "SELECT COUNT(*) FROM dim_customer WHERE first_name = 'SILENT'") == 1
+    assert "Reconcile repaired 0 of 9 tables" in run_cli(["reconcile"], env)
+
+
+def test_reconcile_removes_bridge_rows_of_deleted_film(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    with sqlite3.connect(source) as con:
+        film_id = con.execute("SELECT MIN(film_id) FROM film_actor WHERE film_id IN "
+                              "(SELECT film_id FROM film_category)").fetchone()[0]
+        for table in ("film_actor", "film_category", "film"):
+            con.execute(f"DELETE FROM {table} WHERE film_id = ?", (film_id,))
+
+    out = run_cli(["reconcile", "--tables", "dim_film,bridge_film_actor,bridge_film_category"], env)
+    assert "dim_film: 0 missing, 1 extra, 0 changed" in out
+
+    orphans = "SELECT COUNT(*) FROM {0} WHERE film_key NOT IN (SELECT film_key FROM dim_film)"
+    assert count(db_path, orphans.format("bridge_film_actor")) == 0
+    assert count(db_path, orphans.format("bridge_film_category")) == 0
+    assert count(db_path, "SELECT COUNT(*) FROM bridge_film_actor") == count(source, "SELECT COUNT(*) FROM film_actor")
+    assert count(db_path, "SELECT COUNT(*) FROM bridge_film_category") == \
+        count(source, "SELECT COUNT(*) FROM film_category")
+
+
+def test_watch_syncs_changes_and_stops_on_sigterm(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    p = subprocess.Popen(["python", "app.py", "watch", "--min-interval", "0.2", "--max-interval", "0.5"],
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+    try:
+        time.sleep(2)
+        apply_changes(source, ratio=0.05)
+        deadline = time.time() + 30
+        while time.time() < deadline and count(db_path, "SELECT COUNT(*) FROM fact_rental") != \
+                count(source, "SELECT COUNT(*) FROM rental"):
+            time.sleep(0.5)
+    finally:
+        p.send_signal(signal.SIGTERM)
+        out, _ = p.communicate(timeout=30)
+
+    assert p.returncode == 0
+    assert "Synced" in out and "Watch stopped" in out
+    assert count(db_path, "SELECT COUNT(*) FROM fact_rental") == count(source, "SELECT COUNT(*) FROM rental")
+
+
+def test_aggregates_follow_incremental_changes(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    apply_changes(source, ratio=0.05)
+    with sqlite3.connect(source) as con:
+        con.execute("UPDATE film_category SET category_id = category_id % 16 + 1, "
+                    "last_update = datetime('now') WHERE film_id IN (1, 2)")
+    run_cli(["incremental"], env)
+
+    assert "0 inconsistent" in run_cli(["check-aggregates"], env)
+    assert count(db_path, "SELECT SUM(rentals) FROM agg_store_day_rentals") == \
+        count(source, "SELECT COUNT(*) FROM rental")
+    assert count(db_path, "SELECT rentals FROM agg_open_rentals WHERE store_key = 1") + \
+        count(db_path, "SELECT rentals FROM agg_open_rentals WHERE store_key = 2") == \
+        count(source, "SELECT COUNT(*) FROM rental WHERE return_date IS NULL")
+
+
+def test_stats_flags_latest_run_below_median(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    # rows/s per run, oldest first: one slow outlier among fact_rental's
+    # earlier runs, and a slow latest fact_payment run.
+    history = {"fact_rental": [1000, 1000, 20, 1000, 980], "fact_payment": [1000, 1000, 1000, 300]}
+    with sqlite3.connect(db_path) as con:
+        for stage, rates in history.items():
+            for i, rate in enumerate(rates):
+                con.execute("INSERT INTO sync_run (run_id, command, stage, status, started_at, seconds, "
+                            "extract_seconds, transform_seconds, load_seconds, rows_read, rows_written, "
+                            "rows_skipped) VALUES (?, 'incremental', ?, 'ok', ?, 1, 0, 0, 0, ?, ?, 0)",
+                            (f"run{i}", stage, f"2026-01-0{i + 1} 00:00:00", rate, rate))
+
+    out = run_cli(["stats"], env)
+    lines = {line.split()[0]: line for line in out.splitlines() if line.startswith("  ")}
+    assert "-2% vs median" in lines["fact_rental"] and "REGRESSED" not in lines["fact_rental"]
+    assert "-70% vs median  REGRESSED" in lines["fact_payment"]
+    assert "1 stage(s) regressed more than 20%" in out
+
+
+def test_key_cache_is_rebuilt_after_the_target_changes(synthetic_env, tmp_path: Path):
+    env, source, db_path = synthetic_env
+    env = dict(env, SYNC_KEY_CACHE=str(tmp_path / "keys.pickle"))
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    assert (tmp_path / "keys.pickle").exists()
+    # Customer 5 gets a new surrogate key behind the cache's back.
+    with sqlite3.connect(db_path) as con:
+        con.execute("UPDATE dim_customer SET customer_key = (SELECT MAX(customer_key) + 1 FROM dim_customer) "
+                    "WHERE customer_id = 5")
+    with sqlite3.connect(source) as con:
+        con.execute("UPDATE rental SET customer_id = 5, last_update = datetime('now', '+1 minute') "
+                    "WHERE rental_id = 10")
+
+    run_cli(["incremental"], env)
+    assert count(db_path, "SELECT customer_key FROM fact_rental WHERE rental_id = 10") == \
+        count(db_path, "SELECT customer_key FROM dim_customer WHERE customer_id = 5")
+
+
+def test_query_top_films_matches_fact_table(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    header, top, timing = run_cli(["query", "top-films", "--limit", "1"], env).strip().splitlines()
+
+    assert header.split()[:2] == ["film_id", "title"]
+    assert int(top.split()[-1]) == count(db_path, "SELECT COUNT(*) FROM fact_rental "
+                                                  "GROUP BY film_key ORDER BY 1 DESC LIMIT 1")
+    assert timing.startswith("1 rows in ")
+    assert "rows in" in run_cli(["query", "revenue-by-category", "--from", "2000-01-01"], env)
+
+
+def test_query_cache_invalidated_by_sync(synthetic_env):
+    env, source, db_path = synthetic_env
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    assert "(computed)" in run_cli(["query", "top-films"], env)
+    assert "(table)" in run_cli(["query", "top-films"], env)
+
+    # Payments only: top-films depends on rental and film, so it stays cached.
+    with sqlite3.connect(source) as con:
+        con.execute("UPDATE payment SET amount = 0.5, last_update = datetime('now') WHERE payment_id = 1")
+    run_cli(["incremental"], env)
+    assert "(table)" in run_cli(["query", "top-films"], env)
+    assert "(computed)" in run_cli(["query", "revenue-by-month"], env)
+
+    apply_changes(source, ratio=0.05)
+    run_cli(["incremental"], env)
+    assert "(computed)" in run_cli(["query", "top-films"], env)
+
+
+def test_export_columnar_appends_after_incremental(synthetic_env, tmp_path: Path):
+    env, source, db_path = synthetic_env
+    output = tmp_path / "columnar"
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    assert "Exported fact_payment" in run_cli(["export-columnar", "--output", str(output)], env)
+    apply_changes(source, ratio=0.05)
+    run_cli(["incremental"], env)
+    assert "Appended fact_payment" in run_cli(["export-columnar", "--output", str(output)], env)
+
+    from columnar import ColumnarTable
+    with ColumnarTable(str(output / "fact_payment")) as table:
+        assert table.rows == count(db_path, "SELECT COUNT(*) FROM fact_payment")
+        assert round(sum(table.column("amount")), 2) == \
+            round(count(db_path, "SELECT SUM(amount) FROM fact_payment"), 2)
+        assert set(table.strings("store_city")) == \
+            {r[0] for r in sqlite3.connect(db_path).execute("SELECT city FROM dim_store")}
+
+
+def test_export_columnar_rewrites_dimension_changes_and_torn_appends(synthetic_env, tmp_path: Path):
+    env, source, db_path = synthetic_env
+    output = tmp_path / "columnar"
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    run_cli(["export-columnar", "--output", str(output)], env)
+    # A film renamed without touching its rentals.
+    with sqlite3.connect(source) as con:
+        con.execute("UPDATE film SET title = 'RENAMED', last_update = datetime('now', '+1 minute') "
+                    "WHERE film_id = (SELECT i.film_id FROM rental r "
+                    "JOIN inventory i ON i.inventory_id = r.inventory_id LIMIT 1)")
+    run_cli(["incremental"], env)
+    # An append that died after writing a row to one column but before header.json.
+    with open(output / "fact_rental" / "rental_id.col", "ab") as f:
+        f.write(b"\0" * 8)
+    apply_changes(source, ratio=0.05)
+    run_cli(["incremental"], env)
+    assert "Appended fact_rental" in run_cli(["export-columnar", "--output", str(output)], env)
+
+    from columnar import ColumnarTable
+    with sqlite3.connect(db_path) as con:
+        expected = con.execute("SELECT f.rental_id, d.title FROM fact_rental f "
+                               "JOIN dim_film d ON d.film_key = f.film_key ORDER BY f.fact_rental_key").fetchall()
+    with ColumnarTable(str(output / "fact_rental")) as table:
+        assert table.rows == len(expected)
+        ids = table.column("rental_id")
+        exported = list(zip(ids.tolist(), table.strings("film_title")))
+        del ids
+    assert exported == expected
+    assert any(title == "RENAMED" for _, title in exported)
+
+
+def test_advise_indexes_drops_duplicate_and_keeps_it_dropped(synthetic_env, tmp_path: Path):
+    env, source, db_path = synthetic_env
+    workload = tmp_path / "workload.json"
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    run_cli(["query", "top-films", "--no-cache"], dict(env, SYNC_CAPTURE_QUERIES=str(workload)))
+    assert "FROM fact_rental" in workload.read_text()
+
+    out = run_cli(["advise-indexes", "--workload", str(workload), "--apply"], env)
+    assert "DROP INDEX ix_fact_rental_rental_id" in out
+    out = run_cli(["full-load", "--defer-indexes"], env)
+    assert "ix_fact_payment_store_key" in out and "ix_sync_run_command_stage" not in out
+
+    indexes = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name = '{}'"
+    assert count(db_path, indexes.format("ix_fact_rental_rental_id")) == 0
+    assert count(db_path, indexes.format("ix_fact_rental_date_key_rented")) == 1
+
+
+def test_sharded_sources_load_into_one_database(synthetic_env, tmp_path: Path):
+    env, source, db_path = synthetic_env
+    other = tmp_path / "sakila_synthetic_2.db"
+    generate_source(other, scale=0.1, seed=3)
+    env = dict(env, MYSQL_URL="", SYNC_SOURCES=f"1={source_url(source)},2={source_url(other)}")
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    apply_changes(other, ratio=0.05)
+    run_cli(["incremental"], env)
+
+    for fact, table in (("fact_rental", "rental"), ("fact_payment", "payment"), ("dim_store", "store")):
+        assert count(db_path, f"SELECT COUNT(*) FROM {fact}") == \
+            count(source, f"SELECT COUNT(*) FROM {table}") + count(other, f"SELECT COUNT(*) FROM {table}")
+    assert count(db_path, "SELECT COUNT(*) FROM sync_state WHERE table_name IN ('rental@1', 'rental@2') "
+                          "AND last_synced_at IS NOT NULL") == 2
+    assert "Validation passed" in run_cli(["validate"], env)
+    assert "found drift in 0 of 18 tables" in run_cli(["reconcile", "--dry-run"], env)
+
+
+def test_fleet_syncs_each_tenant_into_its_own_database(tmp_path: Path):
+    tenants = []
+    for i in range(3):
+        source = tmp_path / f"tenant{i}_source.db"
+        generate_source(source, scale=0.05, seed=10 + i)
+        tenants.append({"name": f"tenant{i}", "source": source_url(source),
+                        "target": str(tmp_path / f"tenant{i}.db")})
+    manifest = tmp_path / "tenants.json"
+    manifest.write_text(json.dumps(tenants))
+    report = tmp_path / "fleet.json"
+    env = dict(os.environ, MYSQL_URL="", SYNC_SOURCES="", SYNC_FLEET_MANIFEST=str(manifest))
+
+    run_cli(["fleet", "--tenants", "2"], env)
+    apply_changes(tmp_path / "tenant1_source.db", ratio=0.05)
+    # --manifest alone is enough, without any source in the environment.
+    env.pop("SYNC_FLEET_MANIFEST")
+    out = run_cli(["fleet", "--manifest", str(manifest), "--report", str(report)], env)
+
+    assert "3 of 3 tenants synced" in out
+    results = json.loads(report.read_text())["tenants"]
+    assert [r["action"] for r in results] == ["incremental"] * 3
+    for i in range(3):
+        source, target = tmp_path / f"tenant{i}_source.db", tmp_path / f"tenant{i}.db"
+        assert count(target, "SELECT COUNT(*) FROM fact_rental") == count(source, "SELECT COUNT(*) FROM rental")
+        assert count(target, "SELECT COUNT(*) FROM dim_customer WHERE last_name LIKE 'CHANGED%'") == \
+            count(source, "SELECT COUNT(*) FROM customer WHERE last_name LIKE 'CHANGED%'")
+
+
+def test_split_pk_range_covers_every_key():
+    from extract import split_pk_range
+
+    assert split_pk_range(1, 10, 3) == [(1, 3), (4, 7), (8, 10)]
+    assert split_pk_range(5, 6, 4) == [(5, 5), (6, 6)]
+
+
+@pytest.mark.parametrize("parallelism", [1, 3])
+def test_full_load_resumes_after_interruption(synthetic_env, parallelism):
+    env, source, db_path = synthetic_env
+    args = ["full-load", "--chunk-size", "100", "--extract-parallelism", str(parallelism)]
+
+    run_cli(["init"], env)
+    # Fails the fact_payment chunk that would bring it past 500 rows.
+    with sqlite3.connect(db_path) as con:
+        con.execute("CREATE TRIGGER interrupt BEFORE UPDATE ON load_checkpoint "
+                    "WHEN NEW.table_name = 'fact_payment' AND NEW.rows_loaded > 500 "
+                    "BEGIN SELECT RAISE(ABORT, 'interrupted'); END")
+    with pytest.raises(subprocess.CalledProcessError) as failed:
+        run_cli(args, env)
+    assert "interrupted" in failed.value.stdout + failed.value.stderr
+    assert 0 < count(db_path, "SELECT COUNT(*) FROM fact_payment") < count(source, "SELECT COUNT(*) FROM payment")
+    with sqlite3.connect(db_path) as con:
+        con.execute("DROP TRIGGER interrupt")
+
+    out = run_cli([*args, "--resume"], env)
+    assert "Resuming fact_payment" in out
+    payments = count(source, "SELECT COUNT(*) FROM payment")
+    assert count(db_path, "SELECT COUNT(*) FROM fact_payment") == payments
+    assert count(db_path, "SELECT rows_loaded FROM load_checkpoint WHERE table_name = 'fact_payment'") == payments
+    assert count(db_path, "SELECT COUNT(*) FROM fact_rental") == count(source, "SELECT COUNT(*) FROM rental")
+    assert "0 inconsistent" in run_cli(["check-aggregates"], env)
+
+
+def test_partitioned_facts_sync_and_freeze(synthetic_env):
+    env, source, db_path = synthetic_env
+    env = dict(env, SYNC_FACT_PARTITIONS="month")
+    partition_dir = db_path.parent / f"{db_path.stem}_partitions"
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    # Older than validate's widest window, so the rows apply_changes edits there may stay behind.
+    cutoff = (date.today() - timedelta(days=400)).replace(day=1)
+    out = run_cli(["partitions", "--freeze-before", cutoff.isoformat()], env)
+    assert "frozen" in out
+    apply_changes(source, ratio=0.05)
+    run_cli(["incremental"], env)
+
+    files = sorted(partition_dir.glob("fact_rental_*.db"))
+    assert len(files) > 10
+    assert count(db_path, "SELECT COUNT(*) FROM fact_rental") == 0
+    assert sum(count(f, "SELECT COUNT(*) FROM fact_rental") for f in files) == \
+        count(source, "SELECT COUNT(*) FROM rental")
+    frozen = [f for f in files if int(f.stem.rsplit("_", 1)[1]) < int(cutoff.strftime("%Y%m"))]
+    assert frozen and not any(f.stat().st_mode & 0o222 for f in frozen)
+
+    assert "Validation passed" in run_cli(["validate"], env)
+    assert "0 inconsistent" in run_cli(["check-aggregates"], env)
+    month = date.today().replace(day=1)
+    out = run_cli(["query", "top-films", "--from", month.isoformat(), "--to", date.today().isoformat()], env)
+    assert "rows in" in out
+    out = run_cli(["query", "revenue-by-category", "--no-cache"], env)
+    assert "rows in" in out
+
+
+def test_partitioned_incremental_rerun_after_failed_commit(synthetic_env):
+    env, source, db_path = synthetic_env
+    env = dict(env, SYNC_FACT_PARTITIONS="month")
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    apply_changes(source, ratio=0.05)
+    # The changed payments span more than 10 monthly partitions, so
+    # fact_payment commits a first part and fails in a later one, after
+    # that part's partition rows were written (fact_partition is updated
+    # last). At most 10 partitions are registered per part.
+    with sqlite3.connect(db_path) as con:
+        con.execute("CREATE TABLE hits (n INTEGER)")
+        con.execute("CREATE TRIGGER interrupt BEFORE UPDATE ON fact_partition "
+                    "WHEN NEW.table_name = 'fact_payment' BEGIN INSERT INTO hits VALUES (1); "
+                    "SELECT RAISE(ABORT, 'interrupted') WHERE (SELECT COUNT(*) FROM hits) > 10; END")
+    with pytest.raises(subprocess.CalledProcessError) as failed:
+        run_cli(["incremental"], env)
+    out = failed.value.stdout + failed.value.stderr
+    assert "Committing the fact_payment rows written so far" in out and "interrupted" in out
+    with sqlite3.connect(db_path) as con:
+        con.execute("DROP TRIGGER interrupt")
+
+    run_cli(["incremental"], env)
+    assert "0 inconsistent" in run_cli(["check-aggregates"], env)
+    assert "Validation passed" in run_cli(["validate"], env)
+
+
+def test_partitioned_fact_keys_are_unique_and_export_appends(synthetic_env, tmp_path: Path):
+    env, source, db_path = synthetic_env
+    env = dict(env, SYNC_FACT_PARTITIONS="month")
+    partition_dir = db_path.parent / f"{db_path.stem}_partitions"
+    output = tmp_path / "columnar"
+
+    run_cli(["init"], env)
+    run_cli(["full-load"], env)
+    run_cli(["export-columnar", "--output", str(output)], env)
+    apply_changes(source, ratio=0.05)
+    run_cli(["incremental"], env)
+    out = run_cli(["export-columnar", "--output", str(output)], env)
+    assert "Appended fact_rental" in out and "Appended fact_payment" in out
+
+    for table, key in (("fact_rental", "fact_rental_key"), ("fact_payment", "fact_payment_key")):
+        keys = []
+        for f in partition_dir.glob(f"{table}_*.db"):
+            with sqlite3.connect(f) as con:
+                keys += [k for (k,) in con.execute(f"SELECT {key} FROM {table}")]
+        assert len(keys) == len(set(keys)) == count(source, f"SELECT COUNT(*) FROM {table[5:]}")
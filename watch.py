@@ -0,0 +1,128 @@
+import signal
+import threading
+import time
+
+from sqlalchemy import func, select, literal, union_all, inspect
+
+from config import (BATCH_SIZE, CHUNK_SIZE, SYNC_WORKERS, KEY_CACHE_PATH,
+                    WATCH_MIN_INTERVAL, WATCH_MAX_INTERVAL)
+from database import get_mysql_engine, get_sqlite_session
+from keycache import KeyCache
+from models_mysql import Film, Actor, Category, Store, Customer, Rental, Payment, FilmActor, FilmCategory
+from shards import SHARDS
+from sync import incremental, get_last_sync
+
+# source table -> (model polled, incremental stages to run when it moved)
+WATCHED = {
+    "film": (Film, ("dim_film", "bridge_film_actor", "bridge_film_category")),
+    "actor": (Actor, ("dim_actor", "bridge_film_actor")),
+    "category": (Category, ("dim_category", "bridge_film_category")),
+    "store": (Store, ("dim_store",)),
+    "customer": (Customer, ("dim_customer",)),
+    "rental": (Rental, ("fact_rental",)),
+    "payment": (Payment, ("fact_payment",)),
+    "film_actor": (FilmActor, ("bridge_film_actor",)),
+    "film_category": (FilmCategory, ("bridge_film_category",)),
+}
+
+# sync_state name of each shard's watched table -> (shard, table)
+MARKS = {shard.name(name): (shard, name) for shard in SHARDS for name in WATCHED}
+
+# Idle polls stretch the interval by this factor, up to the maximum.
+BACKOFF = 1.5
+
+
+def unindexed_tables() -> list[tuple]:
+    # (shard, table) of the watched tables without an index starting with
+    # last_update in the source.
+    missing = []
+    for shard in SHARDS:
+        inspector = inspect(get_mysql_engine(shard.url))
+        for name, (model, _) in WATCHED.items():
+            indexes = inspector.get_indexes(model.__tablename__)
+            if not any(ix["column_names"][:1] == ["last_update"] for ix in indexes):
+                missing.append((shard, model.__tablename__))
+    return missing
+
+
+def poll_source() -> dict:
+    # One round trip per shard: MAX(last_update) per watched table. Stock
+    # Sakila has no index on last_update, so each of them is a full scan
+    # until the indexes unindexed_tables() warns about are created.
+    q = union_all(*(
+        select(literal(name).label("table_name"), func.max(model.last_update).label("last_update"))
+        for name, (model, _) in WATCHED.items()
+    ))
+    marks = {}
+    for shard in SHARDS:
+        with get_mysql_engine(shard.url).connect() as conn:
+            marks.update((shard.name(name), ts) for name, ts in conn.execute(q))
+    return marks
+
+
+def synced_marks() -> dict:
+    session = get_sqlite_session()
+    try:
+        return {name: get_last_sync(session, name) for name in MARKS}
+    finally:
+        session.close()
+
+
+def moved_tables(marks: dict, seen: dict) -> list[str]:
+    return [name for name, ts in marks.items()
+            if ts is not None and (seen.get(name) is None or ts > seen[name])]
+
+
+def watch(min_interval: float = WATCH_MIN_INTERVAL, max_interval: float = WATCH_MAX_INTERVAL,
+          batch_size: int = BATCH_SIZE, chunk_size: int = CHUNK_SIZE,
+          workers: int = SYNC_WORKERS) -> None:
+    # Polls the source and runs the incremental stages of the tables whose
+    # MAX(last_update) moved since the last sync. Engines and the key cache
+    # stay open across ticks. The interval drops to min_interval whenever
+    # something changed and grows towards max_interval while idle.
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"Received signal {signum}, stopping after the current tick")
+        stop.set()
+
+    previous = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+    keys = KeyCache(KEY_CACHE_PATH)
+    seen = synced_marks()
+    interval = min_interval
+    ticks = syncs = 0
+    for shard, table in unindexed_tables():
+        where = f" on shard {shard.number}" if shard.number else ""
+        print(f"Warning: {table}.last_update is not indexed{where}, every poll scans the table. "
+              f"Run: CREATE INDEX idx_{table}_last_update ON {table} (last_update)")
+    print(f"Watching {', '.join(WATCHED)} every {min_interval:g}-{max_interval:g}s")
+    try:
+        while not stop.is_set():
+            ticks += 1
+            try:
+                marks = poll_source()
+                moved = moved_tables(marks, seen)
+                if moved:
+                    only = {shard.name(stage) for shard, name in map(MARKS.get, moved)
+                            for stage in WATCHED[name][1]}
+                    started = time.perf_counter()
+                    incremental(batch_size=batch_size, chunk_size=chunk_size, workers=workers,
+                                keys=keys, only=only)
+                    # The polled marks, not sync_state: rows a fact loader had
+                    # to skip must not make the table look moved on every tick.
+                    seen.update((name, marks[name]) for name in moved)
+                    syncs += 1
+                    interval = min_interval
+                    print(f"Synced {', '.join(moved)} in {time.perf_counter() - started:.2f}s")
+                else:
+                    interval = min(max_interval, interval * BACKOFF)
+            except Exception as e:
+                # Source or target unavailable: keep watching, at the slowest pace.
+                print(f"Watch tick failed: {e}")
+                interval = max_interval
+            stop.wait(interval)
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+    print(f"Watch stopped after {ticks} polls, {syncs} syncs")
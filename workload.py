@@ -0,0 +1,71 @@
+import atexit
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+# Read statements run against the SQLite DB, recorded when SYNC_CAPTURE_QUERIES
+# names a file (see database.py). Each distinct SQL text is kept once with a
+# run count and the parameters of one run; the counts are merged into the file
+# when the process exits. advise-indexes replays them.
+_lock = threading.Lock()
+_statements: dict[str, dict] = {}
+_path = None
+_paused = False
+
+
+def record(statement: str, parameters) -> None:
+    head = statement.lstrip()[:6].upper()
+    if _paused or head not in ("SELECT", "WITH S"):
+        return
+    with _lock:
+        entry = _statements.get(statement)
+        if entry is None:
+            params = list(parameters) if isinstance(parameters, (list, tuple)) else []
+            _statements[statement] = {"sql": statement, "count": 1,
+                                      "params": json.loads(json.dumps(params, default=str))}
+        else:
+            entry["count"] += 1
+
+
+def capture_to(path: str) -> None:
+    global _path
+    with _lock:
+        if _path is None:
+            atexit.register(save)
+        _path = path
+
+
+@contextmanager
+def paused():
+    # Statements run inside are not recorded (advise-indexes' own reads).
+    global _paused
+    _paused = True
+    try:
+        yield
+    finally:
+        _paused = False
+
+
+def load(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)["statements"]
+
+
+def save() -> None:
+    with _lock:
+        if _path is None or not _statements:
+            return
+        merged = {s["sql"]: s for s in load(_path)}
+        for sql, entry in _statements.items():
+            if sql in merged:
+                merged[sql]["count"] += entry["count"]
+            else:
+                merged[sql] = entry
+        _statements.clear()
+        tmp = f"{_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"statements": sorted(merged.values(), key=lambda s: -s["count"])}, f, indent=1)
+        os.replace(tmp, _path)